@@ -0,0 +1,313 @@
+import argparse
+import re
+
+import psycopg2
+
+from query_registry import DB_CONFIG, QUERIES, compute_cycle_bounds, prepare_query
+
+# Colunas que viram predicado de índice parcial em vez de coluna da chave
+PARTIAL_COLUMNS = {"status_text"}
+
+# Coluna de um filtro do EXPLAIN VERBOSE: "cp.col" ou "(cp.col)::text"
+_COLUMN = r"\(\(?(?:\w+\.)?(\w+)\)?(?:::[\w ]+?)?"
+# Igualdade com literal ("= 'PAID'::text") ou com parâmetro do plano genérico ("= $1")
+_EQUALITY_RE = re.compile(_COLUMN + r" = (?:'([^']*)'::[\w ]+|(\$\d+))\)")
+_ANY_RE = re.compile(_COLUMN + r" = ANY ")
+_RANGE_RE = re.compile(_COLUMN + r" (?:>=|>|<=|<) ")
+_COLUMN_RE = re.compile(r"^(?:\w+\.)?(\w+)$")
+# Sort Key que é só uma coluna ("core_bankbalance.date_time DESC"); expressões
+# (ex.: "(date_trunc(...)) DESC") e NULLS fora do padrão não são atendidas por índice simples
+_SORT_COLUMN_RE = re.compile(r"^(\w+)\.(\w+)(?:\s+(ASC|DESC))?$", re.I)
+# ORDER BY externo do SQL registrado e cada item dele ("date_time DESC")
+_ORDER_BY_RE = re.compile(r"ORDER BY\s+(.+?)\s*(?:\bLIMIT\b|\bOFFSET\b|$)", re.S | re.I)
+_ORDER_ITEM_RE = re.compile(r"^(\w+\.)?(\w+)(?:\s+(ASC|DESC))?$", re.I)
+# Apelidos do SELECT: todos ("... AS nome") e os que só renomeiam uma coluna ("balance AS min_balance")
+_ALIAS_RE = re.compile(r"\bAS\s+(\w+)", re.I)
+_COLUMN_ALIAS_RE = re.compile(r"(?:\bSELECT|,)\s*(?:\w+\.)?(\w+)\s+AS\s+(\w+)\b", re.I)
+
+# Nós de scan para os quais o audit propõe índice
+INDEXABLE_SCANS = {"Seq Scan", "Index Scan", "Index Only Scan", "Bitmap Heap Scan"}
+
+# Nós que desfazem a relação entre a ordenação de cima e as linhas do scan de baixo
+_ORDER_BARRIERS = {"Aggregate", "Group", "WindowAgg", "Hash"}
+
+############# PARÂMETROS DE EXEMPLO #############
+
+def sample_params():
+    """Parâmetros usados para executar cada consulta do registro durante a auditoria."""
+    params = compute_cycle_bounds()
+    params["start_date"] = params["inicio_30d"]
+    params["end_date"] = params["agora"]
+    params["account_bank_text"] = "transfeera"
+    return params
+
+############# EXPLAIN #############
+
+def explain_query(cursor, name, params):
+    """Executa EXPLAIN (ANALYZE, BUFFERS) da consulta registrada e retorna o plano em JSON."""
+    prepare_query(cursor, name)
+    names = QUERIES[name]["params"]
+    values = tuple(params[param] for param in names)
+    placeholders = ", ".join(["%s"] * len(values))
+    execute = f"EXECUTE {name}({placeholders})" if values else f"EXECUTE {name}"
+    cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, VERBOSE, FORMAT JSON) {execute}", values)
+    return cursor.fetchone()[0][0]
+
+def walk_plan(node):
+    """Percorre todos os nós do plano em profundidade."""
+    yield node
+    for child in node.get("Plans", []):
+        yield from walk_plan(child)
+
+def _scan_contexts(node, sort_keys=None, limited=False):
+    """
+    Percorre o plano devolvendo (nó de scan, Sort Key acima dele, se há LIMIT acima dele).
+
+    A ordenação e o LIMIT só valem para o scan quando chegam a ele sem
+    passar por join ou agregação.
+    """
+    if node["Node Type"] == "Sort":
+        sort_keys = node.get("Sort Key", [])
+    elif node["Node Type"] == "Limit":
+        limited = True
+    if "Relation Name" in node:
+        yield node, sort_keys, limited
+    children = node.get("Plans", [])
+    if len(children) > 1 or node["Node Type"] in _ORDER_BARRIERS:
+        sort_keys, limited = None, False
+    for child in children:
+        yield from _scan_contexts(child, sort_keys, limited)
+
+def _order_from_sort_keys(sort_keys, qualifiers):
+    """Colunas da relação (com ASC/DESC) que formam o prefixo da Sort Key; para na primeira expressão."""
+    order = []
+    for key in sort_keys:
+        match = _SORT_COLUMN_RE.match(key.strip())
+        if not match or match.group(1) not in qualifiers:
+            break
+        order.append((match.group(2), "DESC" if (match.group(3) or "").upper() == "DESC" else ""))
+    return order
+
+def _order_from_sql(sql):
+    """
+    Colunas do ORDER BY externo do SQL (usado quando o plano ordena por índice, sem nó Sort).
+
+    Como no Postgres, um nome sem tabela no ORDER BY é primeiro o apelido
+    de saída: apelido de expressão encerra a ordenação aproveitável.
+    """
+    matches = _ORDER_BY_RE.findall(sql or "")
+    if not matches:
+        return []
+    aliases = set(_ALIAS_RE.findall(sql))
+    column_aliases = {alias: column for column, alias in _COLUMN_ALIAS_RE.findall(sql)}
+    order = []
+    for item in matches[-1].split(","):
+        match = _ORDER_ITEM_RE.match(item.strip())
+        if not match:
+            break
+        qualifier, column, direction = match.groups()
+        if not qualifier and column in aliases:
+            if column not in column_aliases:
+                break
+            column = column_aliases[column]
+        order.append((column, "DESC" if (direction or "").upper() == "DESC" else ""))
+    return order
+
+def summarize_plan(plan, sql=None):
+    """
+    Extrai de cada nó de scan o tipo, estimativa x real e uso de buffers.
+
+    Para scans sob um LIMIT também guarda a ordenação que eles precisam
+    atender (Sort Key acima do scan, ou o ORDER BY do `sql` quando o plano
+    já ordena por um índice), usada na proposta de índices.
+    """
+    relations = {node["Relation Name"] for node in walk_plan(plan["Plan"]) if "Relation Name" in node}
+    scans = []
+    for node, sort_keys, limited in _scan_contexts(plan["Plan"]):
+        loops = node.get("Actual Loops", 1) or 1
+        order = []
+        if limited and sort_keys:
+            order = _order_from_sort_keys(sort_keys, {node["Relation Name"], node.get("Alias")})
+        elif limited and len(relations) == 1 and node["Node Type"] != "Seq Scan":
+            order = _order_from_sql(sql)
+        scans.append({
+            "node_type": node["Node Type"],
+            "relation": node["Relation Name"],
+            "index": node.get("Index Name"),
+            "plan_rows": node.get("Plan Rows", 0),
+            "actual_rows": node.get("Actual Rows", 0) * loops,
+            "removed_by_filter": node.get("Rows Removed by Filter", 0) * loops,
+            "shared_hit": node.get("Shared Hit Blocks", 0),
+            "shared_read": node.get("Shared Read Blocks", 0),
+            "filter": node.get("Filter"),
+            "index_cond": node.get("Index Cond") or node.get("Recheck Cond"),
+            "order": order,
+            "output": node.get("Output", []),
+        })
+    return {
+        "planning_time": plan.get("Planning Time", 0.0),
+        "execution_time": plan.get("Execution Time", 0.0),
+        "scans": scans,
+    }
+
+############# RECOMENDAÇÃO DE ÍNDICES #############
+
+def propose_index(scan):
+    """
+    Propõe um índice parcial/covering para um Seq Scan, ou para um scan por índice que ainda filtra linhas.
+
+    Igualdades viram as primeiras colunas da chave; depois vem a ordenação
+    pedida acima do scan (ex.: ORDER BY ... DESC LIMIT 1) ou, sem ela, as
+    comparações de intervalo. Igualdades em PARTIAL_COLUMNS viram o WHERE do
+    índice e as demais colunas lidas pelo nó entram no INCLUDE.
+    """
+    if scan["node_type"] not in INDEXABLE_SCANS:
+        return None
+    if scan["node_type"] == "Seq Scan":
+        if not scan["filter"] and not scan["order"]:
+            return None
+    elif not scan["filter"]:
+        # O índice usado já atende filtro e ordenação
+        return None
+
+    filter_text = " AND ".join(text for text in (scan["filter"], scan["index_cond"]) if text)
+    where = []
+    partial = set()
+    keys = []
+    for column, value, param in _EQUALITY_RE.findall(filter_text):
+        if column in PARTIAL_COLUMNS and not param:
+            where.append(f"{column} = '{value}'")
+            partial.add(column)
+        elif column not in keys:
+            keys.append(column)
+    for column in _ANY_RE.findall(filter_text):
+        if column not in keys:
+            keys.append(column)
+    directions = {}
+    if scan["order"]:
+        for column, direction in scan["order"]:
+            if column in partial:
+                continue
+            if column in keys:
+                # Coluna de igualdade já está na chave; a ordem dela não importa
+                continue
+            keys.append(column)
+            directions[column] = direction
+    else:
+        for column in _RANGE_RE.findall(filter_text):
+            if column not in keys:
+                keys.append(column)
+    if not keys:
+        return None
+
+    include = []
+    for output in scan["output"]:
+        match = _COLUMN_RE.match(output.strip())
+        if match and match.group(1) not in keys + include and match.group(1) not in partial:
+            include.append(match.group(1))
+
+    table = scan["relation"]
+    index_name = f"idx_audit_{table}_{'_'.join(keys)}"[:63]
+    columns = [f"{key} {directions[key]}".rstrip() if key in directions else key for key in keys]
+    ddl = f"CREATE INDEX {index_name} ON {table} ({', '.join(columns)})"
+    if include:
+        ddl += f" INCLUDE ({', '.join(include)})"
+    if where:
+        ddl += f" WHERE {' AND '.join(where)}"
+    return {"name": index_name, "table": table, "ddl": ddl}
+
+############# RELATÓRIO #############
+
+def print_summary(name, summary):
+    print(f"\n--- {name} ---")
+    print(f"Planejamento: {summary['planning_time']:.2f}ms | Execução: {summary['execution_time']:.2f}ms")
+    for scan in summary["scans"]:
+        target = scan["relation"] + (f" via {scan['index']}" if scan["index"] else "")
+        flag = "⚠️ " if scan["node_type"] == "Seq Scan" or scan["filter"] else "  "
+        print(
+            f"{flag}{scan['node_type']} em {target}: "
+            f"estimado={scan['plan_rows']} real={scan['actual_rows']} "
+            f"removidas_pelo_filtro={scan['removed_by_filter']} "
+            f"buffers hit={scan['shared_hit']} read={scan['shared_read']}"
+        )
+
+def audit(conn, names, params):
+    """Roda o EXPLAIN de cada consulta e retorna (resumos, índices propostos)."""
+    summaries = {}
+    proposals = {}
+    with conn.cursor() as cursor:
+        for name in names:
+            summary = summarize_plan(explain_query(cursor, name, params), QUERIES[name]["sql"])
+            summaries[name] = summary
+            print_summary(name, summary)
+            for scan in summary["scans"]:
+                proposal = propose_index(scan)
+                if proposal and proposal["name"] not in proposals:
+                    proposals[proposal["name"]] = proposal
+    return summaries, proposals
+
+def verify(conn, names, params, proposals, before, keep=False):
+    """
+    Cria os índices propostos, re-executa os planos e compara com a rodada anterior.
+
+    Tudo roda numa transação que é desfeita no final, a não ser que keep=True.
+    """
+    with conn.cursor() as cursor:
+        for proposal in proposals.values():
+            print(f"Criando: {proposal['ddl']}")
+            cursor.execute(proposal["ddl"])
+        for table in sorted({proposal["table"] for proposal in proposals.values()}):
+            cursor.execute(f"ANALYZE {table}")
+
+    print("\nRe-executando planos com os índices propostos...")
+    after, _ = audit(conn, names, params)
+
+    print(f"\n{'='*50}")
+    print("Comparação (execução antes -> depois):")
+    for name in names:
+        seq_before = sum(1 for scan in before[name]["scans"] if scan["node_type"] == "Seq Scan")
+        seq_after = sum(1 for scan in after[name]["scans"] if scan["node_type"] == "Seq Scan")
+        print(
+            f"  {name}: {before[name]['execution_time']:.2f}ms -> {after[name]['execution_time']:.2f}ms "
+            f"| seq scans {seq_before} -> {seq_after}"
+        )
+
+    if keep:
+        conn.commit()
+        print("✓ Índices mantidos no banco")
+    else:
+        conn.rollback()
+        print("✓ Índices descartados (rollback)")
+    return after
+
+def main():
+    parser = argparse.ArgumentParser(description="Auditoria de planos das consultas do registro.")
+    parser.add_argument("--dsn", help="DSN do banco alvo (padrão: variáveis DB_*)")
+    parser.add_argument("--query", action="append", choices=sorted(QUERIES), help="Audita só esta consulta (pode repetir)")
+    parser.add_argument("--verify", action="store_true", help="Cria os índices propostos e re-executa os planos")
+    parser.add_argument("--keep", action="store_true", help="Com --verify, mantém os índices criados")
+    args = parser.parse_args()
+
+    names = args.query or sorted(QUERIES)
+    params = sample_params()
+    conn = psycopg2.connect(args.dsn) if args.dsn else psycopg2.connect(**DB_CONFIG)
+    try:
+        print(f"Auditando {len(names)} consultas...")
+        before, proposals = audit(conn, names, params)
+
+        print(f"\n{'='*50}")
+        if not proposals:
+            print("✓ Nenhum Seq Scan com filtro encontrado; sem índices a propor")
+            return
+        print("Índices propostos:")
+        for proposal in proposals.values():
+            print(f"  {proposal['ddl']};")
+
+        if args.verify:
+            verify(conn, names, params, proposals, before, keep=args.keep)
+    finally:
+        conn.rollback()
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,3 @@
-import psycopg2
 import time
 import pygsheets
 import pandas as pd
@@ -7,6 +6,11 @@ import os
 import json
 from pathlib import Path
 import numpy as np
+from query_registry import QueryTimeout, close_connections, compute_cycle_bounds, print_query_stats, run_query
+from sheets_outbox import SheetsOutbox, outbox_path
+from cycle_executor import CycleExecutor, describe_stale
+from snapshot_store import SnapshotStore
+from sheets_publisher import FanOutPublisher
 
 ############# CONFIGURAÇÃO DO GOOGLE SHEETS #############
 
@@ -25,20 +29,22 @@ try:
     print("✓ Conectado à aba jaci")
 
     print("Conexão com Google Sheets estabelecida com sucesso!")
+
+    # Fila local de escritas no Sheets (consolidada e com limite de cota)
+    outbox = SheetsOutbox(outbox_path("balances"))
 except Exception as e:
     print(f"Erro ao conectar ao Google Sheets: {e}")
     raise
 
-############# FUNÇÕES AUXILIARES #############
+# Histórico local dos saldos (um snapshot por ciclo)
+snapshots = SnapshotStore()
 
-def get_last_row(worksheet):
-    try:
-        last_row = len(worksheet.get_col(9, include_tailing_empty=False)) + 1
-        print(f"Última linha encontrada em {worksheet.title}: {last_row}")
-        return last_row
-    except Exception as e:
-        print(f"Erro ao obter última linha: {e}")
-        return 1
+# Planilhas/abas extras que recebem os mesmos dados (PUBLISH_TARGETS)
+publisher = FanOutPublisher(
+    authorize=lambda: pygsheets.authorize(service_file=os.getenv('GOOGLE_SHEETS_CREDS', 'controles.json'))
+)
+
+############# FUNÇÕES AUXILIARES #############
 
 def convert_to_numeric(value):
     """Converte um valor para numérico, tratando casos especiais"""
@@ -62,60 +68,33 @@ def convert_to_numeric(value):
 
 ############# FUNÇÕES DE CONSULTA AO BANCO #############
 
-def get_balances(cursor):
+def get_balances():
     try:
         return
     except Exception as e:
         print(f"Erro ao obter saldos das contas: {e}")
         return
 
-def get_payments(cursor):
+def get_payments(bounds):
     try:
-        query = """
-        SELECT DISTINCT
-            DATE_TRUNC('day', cp.created_at_date AT TIME ZONE 'America/Sao_Paulo') AS data, 
-            cm.name_text AS merchant, 
-            cp.provider_text AS provider, 
-            cp.method_text AS meth, 
-            COUNT(*) AS quantidade, 
-            SUM(cp.amount_decimal) AS volume
-        FROM core_payment cp 
-        JOIN core_merchant cm ON cm.id = cp.merchant_id
-        WHERE cp.status_text = 'PAID' 
-        AND cp.created_at_date >= (DATE_TRUNC('day', NOW() AT TIME ZONE 'America/Sao_Paulo') AT TIME ZONE 'America/Sao_Paulo' AT TIME ZONE 'GMT')
-        GROUP BY data, merchant, cm.name_text, cp.provider_text, cp.method_text
-        ORDER BY data DESC;
-        """
         print("Executando query de pagamentos do dia...")
-        cursor.execute(query)
-        results = cursor.fetchall()
+        results, _ = run_query("get_payments", bounds)
         df = pd.DataFrame(results, columns=["data", "merchant", "provider", "meth", "quantidade", "volume"])
         if not df.empty:
             df = df.drop_duplicates()
             print(f"✓ Query de pagamentos retornou {len(df)} registros do dia")
         return df
+    except QueryTimeout:
+        # Deixa o executor marcar a etapa como desatualizada em vez de publicar vazio
+        raise
     except Exception as e:
         print(f"Erro ao obter pagamentos: {e}")
         return pd.DataFrame()
 
-def get_backtransactions(cursor):
+def get_backtransactions(bounds):
     try:
-        query = """
-        SELECT DISTINCT
-            (SELECT cm2.name_text FROM core_merchant cm2 WHERE id = merchant_id) AS merchant,
-            description_text AS descricao,
-            SUM(amount_decimal) AS valor_total,
-            DATE_TRUNC('minute', created_at_date AT TIME ZONE 'America/Sao_Paulo') AS data_criacao,
-            MAX(created_at_date) as ultima_atualizacao
-        FROM public.core_backofficetrasactions
-        WHERE created_at_date >= (DATE_TRUNC('day', NOW() AT TIME ZONE 'America/Sao_Paulo') AT TIME ZONE 'America/Sao_Paulo' AT TIME ZONE 'GMT')
-        GROUP BY DATE_TRUNC('minute', created_at_date AT TIME ZONE 'America/Sao_Paulo'), merchant_id, descricao
-        ORDER BY ultima_atualizacao ASC
-        LIMIT 100;
-        """
         print("Executando query de backoffice do dia...")
-        cursor.execute(query)
-        results = cursor.fetchall()
+        results, _ = run_query("get_backtransactions", bounds)
         df = pd.DataFrame(results, columns=["merchant", "descricao", "valor_total", "data_criacao", "ultima_atualizacao"])
         if not df.empty:
             df['data_criacao'] = df['data_criacao'].dt.strftime('%Y-%m-%d %H:%M')
@@ -123,22 +102,15 @@ def get_backtransactions(cursor):
             df = df.drop_duplicates()
             print(f"✓ Query de backoffice retornou {len(df)} registros do dia")
         return df
+    except QueryTimeout:
+        raise
     except Exception as e:
         print(f"Erro ao obter transações do backoffice: {e}")
         return pd.DataFrame()
 
-def get_jaci_atual_from_postgres(cursor):
+def get_jaci_atual_from_postgres():
     try:
-        query = """
-        SELECT
-            id AS merchant_id,
-            name_text AS merchant_name,
-            balance_decimal AS jaci_atual
-        FROM public.core_merchant
-        ORDER BY name_text;
-        """
-        cursor.execute(query)
-        results = cursor.fetchall()
+        results, _ = run_query("get_jaci_atual")
         df = pd.DataFrame(results, columns=["merchant_id", "merchant_name", "jaci_atual"])
         
         # Converte a coluna jaci_atual para numérico tratando casos especiais
@@ -152,108 +124,134 @@ def get_jaci_atual_from_postgres(cursor):
                 print(f"  ID: {row['merchant_id']}, Nome: {row['merchant_name']}, Saldo: {row['jaci_atual']}")
         
         return df
+    except QueryTimeout:
+        raise
     except Exception as e:
         print(f"Erro ao buscar saldos atuais (Jaci Atual): {e}")
         return pd.DataFrame()
 
-############# LOOP PRINCIPAL #############
+############# ETAPAS DO CICLO #############
 
-print("\nIniciando loop principal...")
-while True:
-    try:
-        current_time = datetime.now()
-        print(f"\n{'='*50}")
-        print(f"Nova atualização iniciada em: {current_time}")
-        print(f"{'='*50}")
+# Prazo de cada etapa em segundos, contado do início do ciclo
+STAGE_BUDGET = int(os.getenv('STAGE_BUDGET_SECONDS', "30"))
 
-        if current_time.hour == 0 and current_time.minute == 0:
-            print("Meia-noite detectada, aguardando 1 minuto...")
-            time.sleep(60)
+executor = CycleExecutor(max_workers=3)
+executor.add_stage("payments", get_payments, STAGE_BUDGET, "Pagamentos", pd.DataFrame)
+executor.add_stage("backoffice", get_backtransactions, STAGE_BUDGET, "Backoffice", pd.DataFrame)
+executor.add_stage("jaci", lambda bounds: get_jaci_atual_from_postgres(), STAGE_BUDGET, "Jaci atual", pd.DataFrame)
 
-        print("\nConectando ao banco de dados...")
-        with psycopg2.connect(
-            host=os.getenv('DB_HOST'),
-            user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASS'),
-            database=os.getenv('DB_NAME'),
-            port=int(os.getenv('DB_PORT', "5432"))
-        ) as conn:
-            print("✓ Conexão estabelecida com sucesso")
-
-            with conn.cursor() as cursor:
-                print("\nAtualizando saldos...")
-                get_balances(cursor)
-
-                print("\nAtualizando pagamentos...")
-                df_payments = get_payments(cursor)
-                if not df_payments.empty:
-                    last_row_JACI = get_last_row(wks_JACI)
-                    wks_JACI.set_dataframe(df_payments, (last_row_JACI, 1), encoding="utf-8", copy_head=False)
-                    print("✓ Pagamentos atualizados com sucesso na aba 'DATABASE JACI'")
-
-                print("\nAtualizando transações do backoffice...")
-                df_backtxs = get_backtransactions(cursor)
-                if not df_backtxs.empty:
-                    last_row_backtxs = get_last_row(wks_backtxs)
-                    wks_backtxs.set_dataframe(df_backtxs, (last_row_backtxs, 1), encoding="utf-8", copy_head=False)
-                    print("✓ Transações do backoffice atualizadas com sucesso na aba 'Backoffice Ajustes'")
-
-                print("\nAtualizando dados na aba 'jaci'...")
-                df_jaci_atual = get_jaci_atual_from_postgres(cursor)
-                if not df_jaci_atual.empty:
-                    try:
-                        print(f"Dados do PostgreSQL: {len(df_jaci_atual)} linhas")
-                        print(f"Primeiros 5 registros:")
-                        print(df_jaci_atual.head())
-                        
-                        # Prepara os dados para atualização completa da planilha
-                        # Cria o DataFrame com as 3 colunas
-                        df_to_update = df_jaci_atual[['merchant_name', 'merchant_id', 'jaci_atual']].copy()
-                        df_to_update.columns = ['Merchant', 'Merchant_id', 'saldo_atual']
-                        
-                        # Arredonda saldo_atual para 2 casas decimais
-                        df_to_update['saldo_atual'] = df_to_update['saldo_atual'].round(2)
-                        
-                        print(f"Dados preparados para atualização: {len(df_to_update)} registros")
-                        print("Estrutura dos dados:")
-                        print(df_to_update.head())
-                        
-                        # Limpa a planilha e adiciona os cabeçalhos + dados
-                        wks_balances.clear()
-                        
-                        # Adiciona cabeçalhos
-                        headers = ['Merchant', 'saldo_atual', 'Merchant_id']
-                        wks_balances.update_row(1, headers)
-                        
-                        # Reorganiza as colunas para a ordem correta: Merchant, saldo_atual, Merchant_id
-                        df_final = df_to_update[['Merchant', 'saldo_atual', 'Merchant_id']]
-                        
-                        # Adiciona os dados a partir da linha 2
-                        wks_balances.set_dataframe(df_final, (2, 1), copy_head=False, encoding="utf-8")
-                        
-                        print(f"✓ Aba 'jaci' atualizada com sucesso com {len(df_final)} registros.")
-                        print("✓ Estrutura: Coluna A=Merchant, Coluna B=saldo_atual, Coluna C=Merchant_id")
-                            
-                    except Exception as e:
-                        print(f"Erro específico na atualização da aba jaci: {e}")
-                        import traceback
-                        print(traceback.format_exc())
-                else:
-                    print("⚠️ Nenhum dado retornado do PostgreSQL para a aba 'jaci'")
+############# CICLO #############
 
-    except Exception as e:
-        print(f"\nERRO CRÍTICO: {e}")
-        import traceback
-        print(traceback.format_exc())
+def run_cycle(bounds):
+    """Executa um ciclo completo de balances com os limites de tempo `bounds`."""
+    print("\nAtualizando saldos...")
+    get_balances()
+
+    print("\nColetando dados do banco...")
+    results = executor.run(bounds)
+    stale_note = describe_stale(results)
+    if stale_note:
+        # Resultados antigos não são reenviados: appends duplicariam linhas e a aba jaci já tem esses dados
+        print(f"⚠️ Etapas fora do prazo, publicação pulada ({stale_note})")
+
+    print("\nAtualizando pagamentos...")
+    df_payments = results["payments"].value
+    if not results["payments"].stale and not df_payments.empty:
+        outbox.enqueue_append(wks_JACI, df_payments)
+        print("✓ Pagamentos enfileirados para a aba 'DATABASE JACI'")
+        publisher.publish("payments", df_payments)
+
+    print("\nAtualizando transações do backoffice...")
+    df_backtxs = results["backoffice"].value
+    if not results["backoffice"].stale and not df_backtxs.empty:
+        outbox.enqueue_append(wks_backtxs, df_backtxs)
+        print("✓ Transações do backoffice enfileiradas para a aba 'Backoffice Ajustes'")
+        publisher.publish("backoffice", df_backtxs)
+
+    print("\nAtualizando dados na aba 'jaci'...")
+    df_jaci_atual = results["jaci"].value
+    if results["jaci"].stale:
+        print("⚠️ Aba 'jaci' mantida com a última publicação")
+    elif not df_jaci_atual.empty:
         try:
-            cursor.close()
-            conn.close()
-        except:
-            pass
-        print("Tentando reiniciar o loop em 60 segundos...")
+            print(f"Dados do PostgreSQL: {len(df_jaci_atual)} linhas")
+            print(f"Primeiros 5 registros:")
+            print(df_jaci_atual.head())
+            
+            # Prepara os dados para atualização completa da planilha
+            # Cria o DataFrame com as 3 colunas
+            df_to_update = df_jaci_atual[['merchant_name', 'merchant_id', 'jaci_atual']].copy()
+            df_to_update.columns = ['Merchant', 'Merchant_id', 'saldo_atual']
+            
+            # Arredonda saldo_atual para 2 casas decimais
+            df_to_update['saldo_atual'] = df_to_update['saldo_atual'].round(2)
+            
+            print(f"Dados preparados para atualização: {len(df_to_update)} registros")
+            print("Estrutura dos dados:")
+            print(df_to_update.head())
+            
+            # Limpa a planilha e adiciona os cabeçalhos + dados
+            outbox.enqueue_clear(wks_balances)
+            
+            # Adiciona cabeçalhos
+            headers = ['Merchant', 'saldo_atual', 'Merchant_id']
+            outbox.enqueue_values(wks_balances, (1, 1), [headers])
+            
+            # Reorganiza as colunas para a ordem correta: Merchant, saldo_atual, Merchant_id
+            df_final = df_to_update[['Merchant', 'saldo_atual', 'Merchant_id']]
+            
+            # Adiciona os dados a partir da linha 2
+            outbox.enqueue_dataframe(wks_balances, df_final, (2, 1), copy_head=False)
+            
+            print(f"✓ Aba 'jaci' enfileirada com {len(df_final)} registros.")
+            print("✓ Estrutura: Coluna A=Merchant, Coluna B=saldo_atual, Coluna C=Merchant_id")
+
+            publisher.publish("balances", df_jaci_atual)
+
+            # Guarda o snapshot dos saldos no histórico local
+            snapshots.append("balances", df_jaci_atual, bounds["agora"])
+            snapshots.maintain("balances")
+                
+        except Exception as e:
+            print(f"Erro específico na atualização da aba jaci: {e}")
+            import traceback
+            print(traceback.format_exc())
+    else:
+        print("⚠️ Nenhum dado retornado do PostgreSQL para a aba 'jaci'")
+
+    print("\nEnviando escritas pendentes ao Google Sheets...")
+    outbox.flush(gc)
+    print_query_stats()
+
+############# LOOP PRINCIPAL #############
+
+def main():
+    print("\nIniciando loop principal...")
+    while True:
+        try:
+            current_time = datetime.now()
+            print(f"\n{'='*50}")
+            print(f"Nova atualização iniciada em: {current_time}")
+            print(f"{'='*50}")
+
+            if current_time.hour == 0 and current_time.minute == 0:
+                print("Meia-noite detectada, aguardando 1 minuto...")
+                time.sleep(60)
+
+            # Limites de tempo calculados uma única vez para todas as consultas do ciclo
+            run_cycle(compute_cycle_bounds())
+        except Exception as e:
+            print(f"\nERRO CRÍTICO: {e}")
+            import traceback
+            print(traceback.format_exc())
+            close_connections()
+            print("Tentando reiniciar o loop em 60 segundos...")
+            time.sleep(60)
+            continue
+
+        print(f"\nAtualização concluída em: {datetime.now()}")
+        print("Aguardando 60 segundos para próxima atualização...")
         time.sleep(60)
-        continue
 
-    print(f"\nAtualização concluída em: {datetime.now()}")
-    print("Aguardando 60 segundos para próxima atualização...")
-    time.sleep(60)
+if __name__ == "__main__":
+    main()
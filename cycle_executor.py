@@ -0,0 +1,125 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+
+from query_registry import TZ_SP
+
+############# RESULTADO DE ETAPA #############
+
+class StageResult:
+    """Resultado de uma etapa do ciclo; `stale` indica que veio do cache."""
+
+    def __init__(self, name, label, value, updated_at, stale, error=None):
+        self.name = name
+        self.label = label
+        self.value = value
+        self.updated_at = updated_at
+        self.stale = stale
+        self.error = error
+
+    def age_text(self, now=None):
+        """Idade do resultado em texto curto (ex.: "há 3 min")."""
+        if self.updated_at is None:
+            return "sem dados"
+        now = now or datetime.now(TZ_SP)
+        seconds = max(0, int((now - self.updated_at).total_seconds()))
+        if seconds < 60:
+            return f"há {seconds}s"
+        return f"há {seconds // 60} min"
+
+############# EXECUTOR #############
+
+class CycleExecutor:
+    """
+    Executa as etapas de um ciclo em paralelo, cada uma com um prazo contado do início do ciclo.
+
+    Uma etapa que estoura o prazo continua rodando em segundo plano e o
+    ciclo usa o último resultado bom dela, marcado como desatualizado.
+    Quando a execução atrasada termina, o resultado entra no cache com o
+    horário em que foi disparada (continua desatualizado) e a etapa é
+    disparada de novo com os argumentos do ciclo corrente. Uma etapa que
+    falha também cai no último resultado bom.
+    """
+
+    def __init__(self, max_workers=4):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="etapa")
+        self.stages = {}
+        # nome -> (valor, horário do disparo) do último resultado bom
+        self.cache = {}
+        # nome -> (future, horário do disparo, args) da execução ainda não recolhida
+        self.inflight = {}
+
+    def add_stage(self, name, fn, budget, label=None, default=None):
+        """
+        Registra uma etapa.
+
+        `budget` é o prazo em segundos a partir do início do ciclo; `default`
+        é uma função que gera o valor usado enquanto não há resultado bom.
+        """
+        self.stages[name] = {"fn": fn, "budget": budget, "label": label or name, "default": default}
+
+    def _from_cache(self, name, error):
+        stage = self.stages[name]
+        if name in self.cache:
+            value, updated_at = self.cache[name]
+        else:
+            value = stage["default"]() if stage["default"] else None
+            updated_at = None
+        return StageResult(name, stage["label"], value, updated_at, stale=True, error=error)
+
+    def _harvest(self, name):
+        """Recolhe uma execução de ciclo anterior que terminou depois do prazo."""
+        future, submitted_at, _ = self.inflight.pop(name)
+        label = self.stages[name]["label"]
+        try:
+            value = future.result()
+        except Exception as e:
+            print(f"❌ Erro na etapa {label} (disparada às {submitted_at:%H:%M:%S}): {e}")
+            return
+        self.cache[name] = (value, submitted_at)
+        print(f"✓ {label} disparada às {submitted_at:%H:%M:%S} terminou fora do prazo; resultado guardado como desatualizado")
+
+    def run(self, *args):
+        """Executa todas as etapas com `args` e devolve {nome: StageResult}."""
+        start = time.monotonic()
+        submitted_at = datetime.now(TZ_SP)
+        submitted = set()
+        for name, stage in self.stages.items():
+            if name in self.inflight:
+                if not self.inflight[name][0].done():
+                    continue
+                self._harvest(name)
+            self.inflight[name] = (self.pool.submit(stage["fn"], *args), submitted_at, args)
+            submitted.add(name)
+
+        results = {}
+        for name, stage in self.stages.items():
+            future, stage_submitted_at, _ = self.inflight[name]
+            if name not in submitted:
+                print(f"⏱ {stage['label']} ainda rodando desde {stage_submitted_at:%H:%M:%S}; usando o último resultado bom")
+                results[name] = self._from_cache(name, "execução anterior em andamento")
+                continue
+            remaining = stage["budget"] - (time.monotonic() - start)
+            wait([future], timeout=max(0.0, remaining))
+            if not future.done():
+                print(f"⏱ {stage['label']} passou do prazo de {stage['budget']}s; segue atualizando em segundo plano")
+                results[name] = self._from_cache(name, "prazo excedido")
+                continue
+
+            del self.inflight[name]
+            try:
+                value = future.result()
+            except Exception as e:
+                print(f"❌ Erro na etapa {stage['label']}: {e}")
+                results[name] = self._from_cache(name, str(e))
+                continue
+            self.cache[name] = (value, submitted_at)
+            results[name] = StageResult(name, stage["label"], value, submitted_at, stale=False)
+        return results
+
+def describe_stale(results, now=None):
+    """Texto para a célula de status listando as etapas desatualizadas e a idade de cada uma."""
+    stale = [result for result in results.values() if result.stale]
+    if not stale:
+        return ""
+    return "desatualizado: " + ", ".join(f"{result.label} ({result.age_text(now)})" for result in stale)
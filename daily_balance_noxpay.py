@@ -3,82 +3,38 @@ import json
 from time import sleep
 from datetime import datetime
 import pygsheets
-import os
 import pytz
-import psycopg2
+from query_registry import DB_CONFIG, QueryTimeout, close_connections, get_connection, print_query_stats, run_query
+from sheets_outbox import SheetsOutbox, outbox_path
 
-# Configurações do banco de dados PostgreSQL
-DB_HOST = os.getenv('DB_HOST')
-DB_PORT = int(os.getenv('DB_PORT', "5432"))
-DB_NAME = os.getenv('DB_NAME')
-DB_USER = os.getenv('DB_USER')
-DB_PASS = os.getenv('DB_PASS')
+# Fila local de escritas no Sheets (consolidada e com limite de cota)
+outbox = SheetsOutbox(outbox_path("daily_balance"))
 
 def safe_update_cell(sheet, cell_address, value):
-    """Atualiza uma célula usando o método mais compatível disponível"""
+    """Enfileira a atualização de uma célula no outbox; o envio acontece no flush"""
     try:
-        # Tenta primeiro com update_value (versões mais recentes)
-        if hasattr(sheet, 'update_value'):
-            sheet.update_value(cell_address, str(value))
-            return True
-        # Se não funcionar, tenta com update_acell (versões antigas)
-        elif hasattr(sheet, 'update_acell'):
-            sheet.update_acell(cell_address, str(value))
-            return True
-        # Se nada funcionar, usa update_values como alternativa
-        elif hasattr(sheet, 'update_values'):
-            # Converte A1 notation para row/col
-            import re
-            match = re.match(r'([A-Z]+)(\d+)', cell_address)
-            if match:
-                col_str, row_str = match.groups()
-                # Converte coluna letra para número (A=1, B=2, etc.)
-                col = 0
-                for char in col_str:
-                    col = col * 26 + (ord(char) - ord('A') + 1)
-                row = int(row_str)
-                
-                sheet.update_values(f'{cell_address}:{cell_address}', [[str(value)]])
-                return True
-        
-        print(f"❌ Nenhum método de atualização funcionou para {cell_address}")
-        return False
-        
+        outbox.enqueue_cell(sheet, cell_address, value)
+        return True
     except Exception as e:
-        print(f"❌ Erro ao atualizar célula {cell_address}: {e}")
+        print(f"❌ Erro ao enfileirar célula {cell_address}: {e}")
         return False
 
 def connect_database():
-    """Conecta ao banco de dados PostgreSQL"""
+    """Conecta ao banco de dados PostgreSQL (reaproveita a conexão do ciclo anterior)"""
     try:
         print("Conectando ao banco de dados PostgreSQL...")
-        connection = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
+        connection = get_connection(DB_CONFIG)
         print("✓ Conexão com banco de dados estabelecida com sucesso.")
         return connection
     except Exception as e:
         print(f"❌ Erro ao conectar com o banco de dados: {e}")
         return None
 
-def get_snapshot_transfeera(cursor, sheet):
+def get_snapshot_transfeera(sheet):
     """Obtém o snapshot mais recente da conta Transfeera"""
     try:
-        cursor.execute("""
-            SELECT  
-                DATE_TRUNC('minute', date_time - INTERVAL '3 hours') AS date_time,
-                account_bank_text,
-                balance AS min_balance
-            FROM public.core_bankbalance
-            WHERE account_bank_text = 'transfeera'
-            ORDER BY date_time DESC
-            LIMIT 1;
-        """)
-        result = cursor.fetchone()
+        rows, _ = run_query("get_snapshot_bankbalance", {"account_bank_text": "transfeera"})
+        result = rows[0] if rows else None
         if result:
             # Usa função robusta para atualizar células
             success1 = safe_update_cell(sheet, "E3", result[2])  # balance
@@ -90,25 +46,18 @@ def get_snapshot_transfeera(cursor, sheet):
                 print(f"⚠️ Snapshot Transfeera parcialmente atualizado: Balance={result[2]}, DateTime={result[0]}")
         else:
             print("⚠️ Nenhum dado encontrado para Transfeera")
+    except QueryTimeout as e:
+        print(f"⚠️ Snapshot Transfeera não atualizado, planilha mantém o valor anterior: {e}")
     except Exception as e:
         print(f"❌ Erro ao obter snapshot Transfeera: {e}")
         import traceback
         print(traceback.format_exc())
 
-def get_snapshot_sqala(cursor, sheet):
+def get_snapshot_sqala(sheet):
     """Obtém o snapshot mais recente da conta Sqala"""
     try:
-        cursor.execute("""
-            SELECT  
-                DATE_TRUNC('minute', date_time - INTERVAL '3 hours') AS date_time,
-                account_bank_text,
-                balance AS min_balance
-            FROM public.core_bankbalance
-            WHERE account_bank_text = 'sqala'
-            ORDER BY date_time DESC
-            LIMIT 1;
-        """)
-        result = cursor.fetchone()
+        rows, _ = run_query("get_snapshot_bankbalance", {"account_bank_text": "sqala"})
+        result = rows[0] if rows else None
         if result:
             # Usa função robusta para atualizar células
             success = safe_update_cell(sheet, "F3", result[2])  # balance
@@ -119,6 +68,8 @@ def get_snapshot_sqala(cursor, sheet):
                 print(f"⚠️ Falha ao atualizar Sqala: Balance={result[2]}, DateTime={result[0]}")
         else:
             print("⚠️ Nenhum dado encontrado para Sqala")
+    except QueryTimeout as e:
+        print(f"⚠️ Snapshot Sqala não atualizado, planilha mantém o valor anterior: {e}")
     except Exception as e:
         print(f"❌ Erro ao obter snapshot Sqala: {e}")
         import traceback
@@ -180,18 +131,12 @@ def get_balances(cursor, jaci_sheet):
     '''
 def check_all_accounts():
     """Função principal para verificar todas as contas"""
-    db_connection = None
-    cursor = None
-    
     try:
         # Conecta ao banco de dados
-        db_connection = connect_database()
-        if not db_connection:
+        if not connect_database():
             print("❌ Falha na conexão com o banco de dados")
             return False
         
-        cursor = db_connection.cursor()
-        
         # Conecta ao Google Sheets
         print("Conectando ao Google Sheets...")
         gc = pygsheets.authorize(service_file='controles.json')
@@ -204,13 +149,18 @@ def check_all_accounts():
         
         # Executa as funções de snapshot
         print("\n--- Atualizando snapshots das contas ---")
-        get_snapshot_transfeera(cursor, wks_IUGU_subacc)
-        get_snapshot_sqala(cursor, wks_IUGU_subacc)
+        get_snapshot_transfeera(wks_IUGU_subacc)
+        get_snapshot_sqala(wks_IUGU_subacc)
+
+        print("\n--- Enviando escritas pendentes ao Google Sheets ---")
+        outbox.flush(gc)
         
         # Executa a função de balances
         #print("\n--- Atualizando balances na página jaci ---")
         #get_balances(cursor, wks_jaci)
         
+        print_query_stats()
+
         print("\n✅ Todas as atualizações concluídas!")
         return True
         
@@ -218,14 +168,10 @@ def check_all_accounts():
         print(f"❌ Erro durante verificação das contas: {e}")
         import traceback
         print(traceback.format_exc())
+        # Fecha as conexões; o próximo ciclo reconecta
+        close_connections()
+        print("✓ Conexão com banco de dados fechada.")
         return False
-    finally:
-        # Fecha as conexões
-        if cursor:
-            cursor.close()
-        if db_connection:
-            db_connection.close()
-            print("✓ Conexão com banco de dados fechada.")
 
 def main():
     print("🚀 Iniciando Daily Balance NOX Pay...")
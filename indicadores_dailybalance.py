@@ -1,10 +1,15 @@
-import psycopg2
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime
 import pygsheets
 import os
 import pytz
 import time
+from query_registry import close_connections, compute_cycle_bounds, print_query_stats, run_query
+from sheets_outbox import SheetsOutbox, outbox_path
+from withdrawal_baselines import WithdrawalBaselines, log_alerts
+from cycle_executor import CycleExecutor, describe_stale
+from snapshot_store import SnapshotStore
+from sheets_publisher import FanOutPublisher
 
 ############# CONFIGURAÇÃO DO GOOGLE SHEETS #############
 gc = pygsheets.authorize(service_account_env_var="GOOGLE_CREDENTIALS")  # Alterado para usar variável de ambiente
@@ -13,14 +18,23 @@ sh = gc.open('Daily Balance - Nox Pay')
 # Página onde os indicadores serão escritos
 wks_ind = sh.worksheet_by_title("indicadores")
 
-# Configurações do Banco de Dados
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST'),
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASS'),
-    'database': os.getenv('DB_NAME'),
-    'port': int(os.getenv('DB_PORT', "5432"))
-}
+# Página onde os alertas de saques anômalos serão escritos
+try:
+    wks_alerts = sh.worksheet_by_title("alertas saques")
+except pygsheets.WorksheetNotFound:
+    wks_alerts = sh.add_worksheet("alertas saques")
+
+# Fila local de escritas no Sheets (consolidada e com limite de cota)
+outbox = SheetsOutbox(outbox_path("indicadores"))
+
+# Médias e desvios de saques por merchant, atualizados a cada hora fechada
+baselines = WithdrawalBaselines()
+
+# Histórico local dos indicadores publicados a cada ciclo
+snapshots = SnapshotStore()
+
+# Planilhas/abas extras que recebem os mesmos indicadores (PUBLISH_TARGETS)
+publisher = FanOutPublisher()
 
 # Configuração do fuso horário
 TZ_SP = pytz.timezone('America/Sao_Paulo')
@@ -33,217 +47,74 @@ def check_trigger():
 
 def reset_trigger():
     """Após a execução, redefine a célula B1 para FALSE."""
-    wks_ind.update_value("B1", "FALSE")
+    outbox.enqueue_cell(wks_ind, "B1", "FALSE")
 
 def update_status(status):
     """Atualiza o status de execução na célula A1."""
-    wks_ind.update_value("A1", status)
+    outbox.enqueue_cell(wks_ind, "A1", status)
 
 ############# CONSULTAS SQL AJUSTADAS PARA INCLUIR MERCHANT_ID #############
 
-def count_pix_transactions(cursor):
-    query = """
-    SELECT 
-        subquery.merchant_id,
-        cm.name_text AS merchant,
-        AVG(subquery.contagem) AS media_pix_minuto
-    FROM (
-        SELECT 
-            cp.merchant_id,
-            DATE_TRUNC('minute', cp.created_at_date) AS minuto,
-            COUNT(*) AS contagem
-        FROM core_payment cp
-        WHERE cp.status_text = 'PAID'
-          AND cp.method_text IN ('PIX', 'PIXOUT')
-          AND cp.created_at_date >= NOW() - INTERVAL '1 hour'
-        GROUP BY cp.merchant_id, minuto
-    ) subquery
-    JOIN core_merchant cm ON subquery.merchant_id = cm.id
-    GROUP BY subquery.merchant_id, cm.name_text
-    ORDER BY media_pix_minuto DESC;
-    """
-    cursor.execute(query)
-    results = cursor.fetchall()
-    colnames = [desc[0] for desc in cursor.description]
+def count_pix_transactions(bounds):
+    results, colnames = run_query("count_pix_transactions", bounds)
     return pd.DataFrame(results, columns=colnames)
 
-def count_daily_transactions(cursor):
-    query = """
-    SELECT 
-        cp.merchant_id,
-        cm.name_text AS merchant,
-        COUNT(*) AS quantidade_pix_dia
-    FROM core_payment cp
-    JOIN core_merchant cm ON cm.id = cp.merchant_id
-    WHERE cp.status_text = 'PAID'
-      AND cp.method_text IN ('PIX', 'PIXOUT')
-      AND cp.created_at_date >= CURRENT_DATE AT TIME ZONE 'America/Sao_Paulo'
-    GROUP BY cp.merchant_id, cm.name_text
-    ORDER BY quantidade_pix_dia DESC;
-    """
-    cursor.execute(query)
-    results = cursor.fetchall()
-    colnames = [desc[0] for desc in cursor.description]
+def count_daily_transactions(bounds):
+    results, colnames = run_query("count_daily_transactions", bounds)
     return pd.DataFrame(results, columns=colnames)
 
-def daily_revenue(cursor):
-    query = """
-    SELECT 
-        cp.merchant_id,
-        cm.name_text AS merchant, 
-        SUM(cp.amount_decimal) AS volume
-    FROM core_payment cp
-    JOIN core_merchant cm ON cm.id = cp.merchant_id
-    WHERE cp.status_text = 'PAID'
-      AND cp.method_text = 'FEE'
-      AND cp.created_at_date >= CURRENT_DATE AT TIME ZONE 'America/Sao_Paulo'
-    GROUP BY cp.merchant_id, cm.name_text
-    ORDER BY volume DESC;
-    """
-    cursor.execute(query)
-    results = cursor.fetchall()
-    colnames = [desc[0] for desc in cursor.description]
+def daily_revenue(bounds):
+    results, colnames = run_query("daily_revenue", bounds)
     return pd.DataFrame(results, columns=colnames)
 
-def monthly_revenue(cursor):
-    query = """
-    SELECT 
-        cp.merchant_id,
-        cm.name_text AS merchant, 
-        SUM(cp.amount_decimal) AS volume_mensal
-    FROM core_payment cp
-    JOIN core_merchant cm ON cm.id = cp.merchant_id
-    WHERE cp.status_text = 'PAID'
-      AND cp.method_text = 'FEE'
-      AND cp.created_at_date >= DATE_TRUNC('month', NOW() AT TIME ZONE 'America/Sao_Paulo')
-    GROUP BY cp.merchant_id, cm.name_text
-    ORDER BY volume_mensal DESC;
-    """
-    cursor.execute(query)
-    results = cursor.fetchall()
-    colnames = [desc[0] for desc in cursor.description]
+def monthly_revenue(bounds):
+    results, colnames = run_query("monthly_revenue", bounds)
     return pd.DataFrame(results, columns=colnames)
 
-def conversion_rate(cursor):
-    query = """
-    SELECT 
-        cp.merchant_id,
-        cm.name_text AS merchant,
-        COUNT(CASE WHEN cp.status_text = 'PAID' THEN 1 END) * 1.0 / NULLIF(COUNT(*), 0) AS taxa_conversao
-    FROM core_payment cp
-    JOIN core_merchant cm ON cm.id = cp.merchant_id
-    WHERE cp.created_at_date >= CURRENT_DATE AT TIME ZONE 'America/Sao_Paulo'
-    GROUP BY cp.merchant_id, cm.name_text
-    ORDER BY taxa_conversao DESC;
-    """
-    cursor.execute(query)
-    results = cursor.fetchall()
-    colnames = [desc[0] for desc in cursor.description]
+def conversion_rate(bounds):
+    results, colnames = run_query("conversion_rate", bounds)
     return pd.DataFrame(results, columns=colnames)
 
-def fail_rate(cursor):
-    query = """
-    SELECT
-        cp.merchant_id,
-        cm.name_text AS merchant,
-        COUNT(CASE WHEN cp.status_text = 'FAIL' THEN 1 END) * 1.0 / NULLIF(COUNT(*), 0) AS taxa_falha
-    FROM core_payment cp
-    JOIN core_merchant cm ON cm.id = cp.merchant_id
-    WHERE cp.created_at_date >= CURRENT_DATE AT TIME ZONE 'America/Sao_Paulo'
-    GROUP BY cp.merchant_id, cm.name_text
-    ORDER BY taxa_falha DESC;
-    """
-    cursor.execute(query)
-    results = cursor.fetchall()
-    colnames = [desc[0] for desc in cursor.description]
+def fail_rate(bounds):
+    results, colnames = run_query("fail_rate", bounds)
     return pd.DataFrame(results, columns=colnames)
     
 
 ############# CONSULTA DE PAGAMENTOS (PIXOUT) PARA INDICADORES #############
-def get_withdrawals(cursor, start_date, end_date):
+def get_withdrawals(start_date, end_date):
     """
     Obtém os pagamentos PIXOUT entre as datas fornecidas.
     """
-    query = """
-    SELECT
-        cp.merchant_id,
-        DATE_TRUNC('hour', cp.finalized_at_date AT TIME ZONE 'America/Sao_Paulo') AS data_hora,
-        cm.name_text AS merchant, 
-        cp.method_text AS method,
-        COUNT(*) AS quantidade,
-        SUM(cp.amount_decimal) AS volume
-    FROM core_payment cp 
-    JOIN core_merchant cm ON cm.id = cp.merchant_id
-    WHERE cp.status_text = 'PAID'
-      AND cp.method_text = 'PIXOUT'
-      AND cp.finalized_at_date BETWEEN %s AND %s
-    GROUP BY cp.merchant_id, data_hora, merchant, method
-    ORDER BY cp.merchant_id, data_hora, merchant;
-    """
-    cursor.execute(query, (start_date, end_date))
-    results = cursor.fetchall()
-    colnames = [desc[0] for desc in cursor.description]
+    params = {"start_date": start_date, "end_date": end_date}
+    results, colnames = run_query("get_withdrawals", params)
     return pd.DataFrame(results, columns=colnames)
 
 ############# MÉTRICAS DE SAQUES - ÚLTIMOS 30 DIAS #############
-def get_withdrawal_metrics(cursor):
+def get_withdrawal_metrics(bounds):
     """
-    Calcula as estatísticas de saques (PIXOUT) nos últimos 30 dias.
-    """
-    end_date = datetime.now(TZ_SP)
-    start_date = end_date - timedelta(days=30)
-
-    df = get_withdrawals(cursor, start_date, end_date)
-
-    if df.empty:
-        return pd.DataFrame(columns=[
-            "merchant_id", "merchant", "mean_1h_volume", "std_1h_volume", "mean_1h_quantidade", "std_1h_quantidade",
-            "mean_12h_volume", "std_12h_volume", "mean_12h_quantidade", "std_12h_quantidade",
-            "mean_1d_volume", "std_1d_volume", "mean_1d_quantidade", "std_1d_quantidade"
-        ])
+    Retorna as estatísticas de saques (PIXOUT) por merchant em janelas de 1h, 12h e 1d nos últimos 30 dias.
 
-    df["data_hora"] = pd.to_datetime(df["data_hora"])
-
-    # Cálculo da média e desvio padrão para 1h, 12h e 24h
-    df_1h = df.groupby(["merchant", "merchant_id", pd.Grouper(key="data_hora", freq="h")])[["volume", "quantidade"]].sum().reset_index()
-    df_12h = df.groupby(["merchant", "merchant_id", pd.Grouper(key="data_hora", freq="12h")])[["volume", "quantidade"]].sum().reset_index()
-    df_1d = df.groupby(["merchant", "merchant_id", pd.Grouper(key="data_hora", freq="d")])[["volume", "quantidade"]].sum().reset_index()
-
-    metrics_1h = df_1h.groupby(["merchant_id", "merchant"]).agg({
-        "volume": ["mean", "std"],
-        "quantidade": ["mean", "std"]
-    }).reset_index()
-    metrics_1h.columns = ["merchant_id", "merchant", "mean_1h_volume", "std_1h_volume", "mean_1h_quantidade", "std_1h_quantidade"]
-
-    metrics_12h = df_12h.groupby(["merchant_id", "merchant"]).agg({
-        "volume": ["mean", "std"],
-        "quantidade": ["mean", "std"]
-    }).reset_index()
-    metrics_12h.columns = ["merchant_id", "merchant", "mean_12h_volume", "std_12h_volume", "mean_12h_quantidade", "std_12h_quantidade"]
-
-    metrics_1d = df_1d.groupby(["merchant_id", "merchant"]).agg({
-        "volume": ["mean", "std"],
-        "quantidade": ["mean", "std"]
-    }).reset_index()
-    metrics_1d.columns = ["merchant_id", "merchant", "mean_1d_volume", "std_1d_volume", "mean_1d_quantidade", "std_1d_quantidade"]
-
-    result = metrics_1h.merge(metrics_12h, on=["merchant_id", "merchant"], how="outer").merge(metrics_1d, on=["merchant_id", "merchant"], how="outer")
-
-    return result
+    As médias/desvios são mantidos de forma incremental (Welford): só as
+    horas fechadas desde o último ciclo são lidas do banco e os buckets
+    que saem da janela de 30 dias são subtraídos. Um timeout (QueryTimeout)
+    segue para o executor, que marca a etapa como desatualizada.
+    """
+    baselines.update(bounds["agora"])
+    return baselines.to_frame()
 
 ############# SAQUES NA ÚLTIMA 1H, 12H, 24H #############
-def get_recent_withdrawals(cursor):
+def get_recent_withdrawals(bounds):
     """
     Obtém os saques dos últimos 1h, 12h e 24h.
     """
-    now = datetime.now(TZ_SP)
-    last_1h = now - timedelta(hours=1)
-    last_12h = now - timedelta(hours=12)
-    last_24h = now - timedelta(hours=24)
+    now = bounds["agora"]
+    last_1h = bounds["inicio_1h"]
+    last_12h = bounds["inicio_12h"]
+    last_24h = bounds["inicio_24h"]
 
-    df_1h = get_withdrawals(cursor, last_1h, now).groupby(["merchant_id", "merchant"])["volume"].sum().reset_index()
-    df_12h = get_withdrawals(cursor, last_12h, now).groupby(["merchant_id", "merchant"])["volume"].sum().reset_index()
-    df_24h = get_withdrawals(cursor, last_24h, now).groupby(["merchant_id", "merchant"])["volume"].sum().reset_index()
+    df_1h = get_withdrawals(last_1h, now).groupby(["merchant_id", "merchant"])["volume"].sum().reset_index()
+    df_12h = get_withdrawals(last_12h, now).groupby(["merchant_id", "merchant"])["volume"].sum().reset_index()
+    df_24h = get_withdrawals(last_24h, now).groupby(["merchant_id", "merchant"])["volume"].sum().reset_index()
 
     df_1h.columns = ["merchant_id", "merchant", "current_1h_withdrawals"]
     df_12h.columns = ["merchant_id", "merchant", "sum_12h_withdrawals"]
@@ -251,72 +122,112 @@ def get_recent_withdrawals(cursor):
 
     return df_1h.merge(df_12h, on=["merchant_id", "merchant"], how="outer").merge(df_24h, on=["merchant", "merchant_id"], how="outer") 
 
+############# ETAPAS DO CICLO #############
+# Prazo de cada etapa em segundos, contado do início do ciclo
+STAGE_BUDGET = int(os.getenv('STAGE_BUDGET_SECONDS', "20"))
+WITHDRAWAL_STAGE_BUDGET = int(os.getenv('WITHDRAWAL_STAGE_BUDGET_SECONDS', "40"))
+
+def _empty(*columns):
+    return lambda: pd.DataFrame(columns=["merchant_id", "merchant", *columns])
+
+executor = CycleExecutor()
+executor.add_stage("pix", count_pix_transactions, STAGE_BUDGET, "Métricas PIX", _empty("media_pix_minuto"))
+executor.add_stage("daily_pix", count_daily_transactions, STAGE_BUDGET, "Métricas diárias", _empty("quantidade_pix_dia"))
+executor.add_stage("revenue", daily_revenue, STAGE_BUDGET, "Receita diária", _empty("volume"))
+executor.add_stage("month_revenue", monthly_revenue, STAGE_BUDGET, "Receita mensal", _empty("volume_mensal"))
+executor.add_stage("conversion", conversion_rate, STAGE_BUDGET, "Taxa de conversão", _empty("taxa_conversao"))
+executor.add_stage("fail", fail_rate, STAGE_BUDGET, "Taxa de falha", _empty("taxa_falha"))
+executor.add_stage("withdrawal_metrics", get_withdrawal_metrics, WITHDRAWAL_STAGE_BUDGET, "Métricas de saque", baselines.to_frame)
+executor.add_stage(
+    "recent_withdrawals", get_recent_withdrawals, WITHDRAWAL_STAGE_BUDGET, "Saques recentes",
+    _empty("current_1h_withdrawals", "sum_12h_withdrawals", "sum_24h_withdrawals"),
+)
+
+############# CICLO #############
+def run_cycle(current_time):
+    """Executa um ciclo completo de indicadores para o horário `current_time`."""
+    # Limites de tempo calculados uma única vez para todas as consultas do ciclo
+    bounds = compute_cycle_bounds(current_time)
+    print(f"\n{'='*50}")
+    print(f"Nova atualização de indicadores iniciada em: {current_time}")
+    print(f"{'='*50}")
+
+    update_status("Atualizando...")
+    outbox.flush(gc, max_retries=0)
+
+    print("\nColetando métricas...")
+    results = executor.run(bounds)
+    for result in results.values():
+        if result.stale:
+            print(f"⚠️ {result.label}: usando resultado anterior ({result.age_text(current_time)})")
+        else:
+            print(f"✓ {result.label} coletada")
+
+    df_pix = results["pix"].value
+    df_daily_pix = results["daily_pix"].value
+    df_revenue = results["revenue"].value
+    df_month_revenue = results["month_revenue"].value
+    df_conversion = results["conversion"].value
+    df_fail = results["fail"].value
+    df_withdrawal_metrics = results["withdrawal_metrics"].value
+    df_recent_withdrawals = results["recent_withdrawals"].value
+
+    # Alertas só com saques recentes novos, para não repetir alertas do cache
+    if not results["recent_withdrawals"].stale:
+        df_alerts = baselines.detect_anomalies(df_recent_withdrawals, current_time)
+        log_alerts(df_alerts)
+        outbox.enqueue_clear(wks_alerts)
+        outbox.enqueue_dataframe(wks_alerts, df_alerts, (1, 1), copy_head=True)
+        if df_alerts.empty:
+            print("✓ Nenhum saque anômalo")
+        else:
+            print(f"⚠️ {len(df_alerts)} alertas de saque anômalo registrados")
+
+    print("\nMesclando dados...")
+    # Mescla os DataFrames corretamente usando `merchant_id`
+    df_indicators = df_revenue.merge(df_pix, on=["merchant_id", "merchant"], how="left").fillna(0)
+    df_indicators = df_indicators.merge(df_daily_pix, on=["merchant_id", "merchant"], how="left").fillna(0)
+    df_indicators = df_indicators.merge(df_month_revenue, on=["merchant_id", "merchant"], how="outer", suffixes=('_daily', '_monthly'))
+    df_indicators = df_indicators.merge(df_conversion, on=["merchant_id", "merchant"], how="outer", suffixes=('', '_conv'))
+    df_indicators = df_indicators.merge(df_fail, on=["merchant_id", "merchant"], how="outer", suffixes=('', '_fail'))
+    df_indicators = df_indicators.merge(df_withdrawal_metrics, on=["merchant_id", "merchant"], how="left")
+    df_indicators = df_indicators.merge(df_recent_withdrawals,on=["merchant_id", "merchant"], how="left")
+    
+    print("\nAtualizando Google Sheets...")
+    # Enfileira para o Google Sheets; o envio acontece no flush do fim do ciclo
+    outbox.enqueue_dataframe(wks_ind, df_indicators, (2, 1), copy_head=True)
+    print("✓ Indicadores enfileirados no outbox")
+    publisher.publish("indicadores", df_indicators)
+
+    # Atualiza o status com a data e hora da última atualização e as etapas desatualizadas
+    last_update = current_time.strftime("%d/%m/%Y %H:%M:%S")
+    stale_note = describe_stale(results, current_time)
+    update_status(f"Última atualização: {last_update}" + (f" | {stale_note}" if stale_note else ""))
+
+    # Guarda no histórico só ciclos com todas as etapas atualizadas
+    if stale_note:
+        print("⚠️ Ciclo fora do histórico (etapas desatualizadas)")
+    else:
+        try:
+            snapshots.append("indicadores", df_indicators, current_time)
+        except Exception as e:
+            print(f"⚠️ Erro ao gravar histórico dos indicadores: {e}")
+    snapshots.maintain("indicadores")
+
+    if outbox.flush(gc):
+        print("✓ Indicadores atualizados com sucesso")
+    print_query_stats()
+
 ############# LOOP PRINCIPAL #############
 def main():
     print("\nIniciando loop principal de indicadores...")
     while True:
         try:
-            current_time = datetime.now(TZ_SP)
-            print(f"\n{'='*50}")
-            print(f"Nova atualização de indicadores iniciada em: {current_time}")
-            print(f"{'='*50}")
-
-            update_status("Atualizando...")
-
-            with psycopg2.connect(**DB_CONFIG) as conn:
-                with conn.cursor() as cursor:
-                    print("\nColetando métricas...")
-                    df_pix = count_pix_transactions(cursor)
-                    print("✓ Métricas PIX coletadas")
-                    
-                    df_daily_pix = count_daily_transactions(cursor)
-                    print("✓ Métricas diárias coletadas")
-                    
-                    df_revenue = daily_revenue(cursor)
-                    print("✓ Receita diária coletada")
-                    
-                    df_month_revenue = monthly_revenue(cursor)
-                    print("✓ Receita mensal coletada")
-                    
-                    df_conversion = conversion_rate(cursor)
-                    print("✓ Taxa de conversão calculada")
-                    
-                    df_fail = fail_rate(cursor)
-                    print("✓ Taxa de falha calculada")
-                    
-                    df_withdrawal_metrics = get_withdrawal_metrics(cursor)
-                    print("✓ Métricas de saque calculadas")
-                    
-                    df_recent_withdrawals = get_recent_withdrawals(cursor)
-                    print("✓ Saques recentes coletados")
-
-                    print("\nMesclando dados...")
-                    # Mescla os DataFrames corretamente usando `merchant_id`
-                    df_indicators = df_revenue.merge(df_pix, on=["merchant_id", "merchant"], how="left").fillna(0)
-                    df_indicators = df_indicators.merge(df_daily_pix, on=["merchant_id", "merchant"], how="left").fillna(0)
-                    df_indicators = df_indicators.merge(df_month_revenue, on=["merchant_id", "merchant"], how="outer", suffixes=('_daily', '_monthly'))
-                    df_indicators = df_indicators.merge(df_conversion, on=["merchant_id", "merchant"], how="outer", suffixes=('', '_conv'))
-                    df_indicators = df_indicators.merge(df_fail, on=["merchant_id", "merchant"], how="outer", suffixes=('', '_fail'))
-                    df_indicators = df_indicators.merge(df_withdrawal_metrics, on=["merchant_id", "merchant"], how="left")
-                    df_indicators = df_indicators.merge(df_recent_withdrawals,on=["merchant_id", "merchant"], how="left")
-                    
-                    print("\nAtualizando Google Sheets...")
-                    # Envia para o Google Sheets
-                    wks_ind.set_dataframe(df_indicators, (2, 1), encoding="utf-8", copy_head=True)
-                    print("✓ Indicadores atualizados com sucesso")
-
-                    # Atualiza o status com a data e hora da última atualização
-                    last_update = current_time.strftime("%d/%m/%Y %H:%M:%S")
-                    update_status(f"Última atualização: {last_update}")
-
+            run_cycle(datetime.now(TZ_SP))
         except Exception as e:
             print(f"\nERRO CRÍTICO: {e}")
             print("Fechando conexão antiga...")
-            try:
-                cursor.close()
-                conn.close()
-            except:
-                pass
+            close_connections()
             print("Tentando reiniciar o loop em 60 segundos...")
             time.sleep(60)
             continue
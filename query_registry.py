@@ -0,0 +1,456 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+import pytz
+
+# Configuração do fuso horário
+TZ_SP = pytz.timezone('America/Sao_Paulo')
+
+# Configurações do Banco de Dados (primário)
+DB_CONFIG = {
+    'host': os.getenv('DB_HOST'),
+    'user': os.getenv('DB_USER'),
+    'password': os.getenv('DB_PASS'),
+    'database': os.getenv('DB_NAME'),
+    'port': int(os.getenv('DB_PORT', "5432"))
+}
+
+# Réplica de leitura para as consultas analíticas; sem DB_REPLICA_* usa o primário
+# (o "or" cobre secrets não configurados, que chegam como string vazia)
+REPLICA_DB_CONFIG = {
+    'host': os.getenv('DB_REPLICA_HOST') or DB_CONFIG['host'],
+    'user': os.getenv('DB_REPLICA_USER') or DB_CONFIG['user'],
+    'password': os.getenv('DB_REPLICA_PASS') or DB_CONFIG['password'],
+    'database': os.getenv('DB_REPLICA_NAME') or DB_CONFIG['database'],
+    'port': int(os.getenv('DB_REPLICA_PORT') or DB_CONFIG['port'])
+}
+
+def _timeout_ms(query_class, kind, default):
+    return int(os.getenv(f"DB_{kind}_TIMEOUT_{query_class.upper()}_MS", default))
+
+# Classe de consulta -> banco de destino e timeouts (em ms), configuráveis por variável de ambiente
+# (ex.: DB_STATEMENT_TIMEOUT_ROLLUP_MS=60000, DB_LOCK_TIMEOUT_BALANCES_MS=500)
+QUERY_CLASSES = {
+    "indicadores": {
+        "target": "replica",
+        "statement_timeout_ms": _timeout_ms("indicadores", "STATEMENT", 20000),
+        "lock_timeout_ms": _timeout_ms("indicadores", "LOCK", 2000),
+    },
+    "rollup": {
+        "target": "replica",
+        "statement_timeout_ms": _timeout_ms("rollup", "STATEMENT", 45000),
+        "lock_timeout_ms": _timeout_ms("rollup", "LOCK", 2000),
+    },
+    "backoffice": {
+        "target": "replica",
+        "statement_timeout_ms": _timeout_ms("backoffice", "STATEMENT", 15000),
+        "lock_timeout_ms": _timeout_ms("backoffice", "LOCK", 2000),
+    },
+    # Saldos precisam do dado mais recente, então continuam no primário
+    "balances": {
+        "target": "primary",
+        "statement_timeout_ms": _timeout_ms("balances", "STATEMENT", 10000),
+        "lock_timeout_ms": _timeout_ms("balances", "LOCK", 1000),
+    },
+}
+
+############# JANELAS DE TEMPO DO CICLO #############
+
+def compute_cycle_bounds(now=None):
+    """
+    Calcula uma única vez os limites de tempo do ciclo (snapshot consistente).
+
+    Todas as consultas do mesmo ciclo recebem estes valores como parâmetros,
+    em vez de cada uma calcular NOW()/CURRENT_DATE dentro do SQL.
+    """
+    if now is None:
+        now = datetime.now(TZ_SP)
+    else:
+        now = now.astimezone(TZ_SP)
+
+    inicio_dia = TZ_SP.localize(datetime(now.year, now.month, now.day))
+    inicio_mes = TZ_SP.localize(datetime(now.year, now.month, 1))
+
+    return {
+        "agora": now,
+        "inicio_dia": inicio_dia,
+        "inicio_mes": inicio_mes,
+        "inicio_1h": now - timedelta(hours=1),
+        "inicio_12h": now - timedelta(hours=12),
+        "inicio_24h": now - timedelta(hours=24),
+        "inicio_30d": now - timedelta(days=30),
+    }
+
+############# REGISTRO DE CONSULTAS #############
+
+# Tipo SQL de cada parâmetro usado nos PREPAREs
+PARAM_TYPES = {
+    "agora": "timestamptz",
+    "inicio_dia": "timestamptz",
+    "inicio_mes": "timestamptz",
+    "inicio_1h": "timestamptz",
+    "inicio_12h": "timestamptz",
+    "inicio_24h": "timestamptz",
+    "inicio_30d": "timestamptz",
+    "start_date": "timestamptz",
+    "end_date": "timestamptz",
+    "account_bank_text": "text",
+}
+
+# nome -> {"sql": texto com $1..$n, "params": nomes dos parâmetros na ordem, "query_class": classe}
+QUERIES = {}
+
+def register_query(name, sql, params, query_class):
+    """Registra uma consulta que será executada como PREPARE no servidor."""
+    for param in params:
+        if param not in PARAM_TYPES:
+            raise ValueError(f"Parâmetro sem tipo registrado: {param}")
+    if query_class not in QUERY_CLASSES:
+        raise ValueError(f"Classe de consulta desconhecida: {query_class}")
+    QUERIES[name] = {"sql": sql, "params": tuple(params), "query_class": query_class}
+
+# ----- indicadores_dailybalance.py -----
+
+register_query("count_pix_transactions", """
+    SELECT
+        subquery.merchant_id,
+        cm.name_text AS merchant,
+        AVG(subquery.contagem) AS media_pix_minuto
+    FROM (
+        SELECT
+            cp.merchant_id,
+            DATE_TRUNC('minute', cp.created_at_date) AS minuto,
+            COUNT(*) AS contagem
+        FROM core_payment cp
+        WHERE cp.status_text = 'PAID'
+          AND cp.method_text IN ('PIX', 'PIXOUT')
+          AND cp.created_at_date >= $1
+        GROUP BY cp.merchant_id, minuto
+    ) subquery
+    JOIN core_merchant cm ON subquery.merchant_id = cm.id
+    GROUP BY subquery.merchant_id, cm.name_text
+    ORDER BY media_pix_minuto DESC
+""", ("inicio_1h",), "indicadores")
+
+register_query("count_daily_transactions", """
+    SELECT
+        cp.merchant_id,
+        cm.name_text AS merchant,
+        COUNT(*) AS quantidade_pix_dia
+    FROM core_payment cp
+    JOIN core_merchant cm ON cm.id = cp.merchant_id
+    WHERE cp.status_text = 'PAID'
+      AND cp.method_text IN ('PIX', 'PIXOUT')
+      AND cp.created_at_date >= $1
+    GROUP BY cp.merchant_id, cm.name_text
+    ORDER BY quantidade_pix_dia DESC
+""", ("inicio_dia",), "indicadores")
+
+register_query("daily_revenue", """
+    SELECT
+        cp.merchant_id,
+        cm.name_text AS merchant,
+        SUM(cp.amount_decimal) AS volume
+    FROM core_payment cp
+    JOIN core_merchant cm ON cm.id = cp.merchant_id
+    WHERE cp.status_text = 'PAID'
+      AND cp.method_text = 'FEE'
+      AND cp.created_at_date >= $1
+    GROUP BY cp.merchant_id, cm.name_text
+    ORDER BY volume DESC
+""", ("inicio_dia",), "indicadores")
+
+register_query("monthly_revenue", """
+    SELECT
+        cp.merchant_id,
+        cm.name_text AS merchant,
+        SUM(cp.amount_decimal) AS volume_mensal
+    FROM core_payment cp
+    JOIN core_merchant cm ON cm.id = cp.merchant_id
+    WHERE cp.status_text = 'PAID'
+      AND cp.method_text = 'FEE'
+      AND cp.created_at_date >= $1
+    GROUP BY cp.merchant_id, cm.name_text
+    ORDER BY volume_mensal DESC
+""", ("inicio_mes",), "indicadores")
+
+register_query("conversion_rate", """
+    SELECT
+        cp.merchant_id,
+        cm.name_text AS merchant,
+        COUNT(CASE WHEN cp.status_text = 'PAID' THEN 1 END) * 1.0 / NULLIF(COUNT(*), 0) AS taxa_conversao
+    FROM core_payment cp
+    JOIN core_merchant cm ON cm.id = cp.merchant_id
+    WHERE cp.created_at_date >= $1
+    GROUP BY cp.merchant_id, cm.name_text
+    ORDER BY taxa_conversao DESC
+""", ("inicio_dia",), "indicadores")
+
+register_query("fail_rate", """
+    SELECT
+        cp.merchant_id,
+        cm.name_text AS merchant,
+        COUNT(CASE WHEN cp.status_text = 'FAIL' THEN 1 END) * 1.0 / NULLIF(COUNT(*), 0) AS taxa_falha
+    FROM core_payment cp
+    JOIN core_merchant cm ON cm.id = cp.merchant_id
+    WHERE cp.created_at_date >= $1
+    GROUP BY cp.merchant_id, cm.name_text
+    ORDER BY taxa_falha DESC
+""", ("inicio_dia",), "indicadores")
+
+register_query("get_withdrawals", """
+    SELECT
+        cp.merchant_id,
+        DATE_TRUNC('hour', cp.finalized_at_date AT TIME ZONE 'America/Sao_Paulo') AS data_hora,
+        cm.name_text AS merchant,
+        cp.method_text AS method,
+        COUNT(*) AS quantidade,
+        SUM(cp.amount_decimal) AS volume
+    FROM core_payment cp
+    JOIN core_merchant cm ON cm.id = cp.merchant_id
+    WHERE cp.status_text = 'PAID'
+      AND cp.method_text = 'PIXOUT'
+      AND cp.finalized_at_date BETWEEN $1 AND $2
+    GROUP BY cp.merchant_id, data_hora, merchant, method
+    ORDER BY cp.merchant_id, data_hora, merchant
+""", ("start_date", "end_date"), "rollup")
+
+# ----- balances_depuracao.py -----
+
+register_query("get_payments", """
+    SELECT DISTINCT
+        DATE_TRUNC('day', cp.created_at_date AT TIME ZONE 'America/Sao_Paulo') AS data,
+        cm.name_text AS merchant,
+        cp.provider_text AS provider,
+        cp.method_text AS meth,
+        COUNT(*) AS quantidade,
+        SUM(cp.amount_decimal) AS volume
+    FROM core_payment cp
+    JOIN core_merchant cm ON cm.id = cp.merchant_id
+    WHERE cp.status_text = 'PAID'
+    AND cp.created_at_date >= $1
+    GROUP BY data, merchant, cm.name_text, cp.provider_text, cp.method_text
+    ORDER BY data DESC
+""", ("inicio_dia",), "rollup")
+
+register_query("get_backtransactions", """
+    SELECT DISTINCT
+        (SELECT cm2.name_text FROM core_merchant cm2 WHERE id = merchant_id) AS merchant,
+        description_text AS descricao,
+        SUM(amount_decimal) AS valor_total,
+        DATE_TRUNC('minute', created_at_date AT TIME ZONE 'America/Sao_Paulo') AS data_criacao,
+        MAX(created_at_date) as ultima_atualizacao
+    FROM public.core_backofficetrasactions
+    WHERE created_at_date >= $1
+    GROUP BY DATE_TRUNC('minute', created_at_date AT TIME ZONE 'America/Sao_Paulo'), merchant_id, descricao
+    ORDER BY ultima_atualizacao ASC
+    LIMIT 100
+""", ("inicio_dia",), "backoffice")
+
+register_query("get_jaci_atual", """
+    SELECT
+        id AS merchant_id,
+        name_text AS merchant_name,
+        balance_decimal AS jaci_atual
+    FROM public.core_merchant
+    ORDER BY name_text
+""", (), "balances")
+
+# ----- daily_balance_noxpay.py -----
+
+# ORDER BY pela coluna qualificada: "date_time" sozinho seria o apelido de saída
+# (a expressão DATE_TRUNC), e aí um índice em date_time não evitaria o Sort
+register_query("get_snapshot_bankbalance", """
+    SELECT
+        DATE_TRUNC('minute', date_time - INTERVAL '3 hours') AS date_time,
+        account_bank_text,
+        balance AS min_balance
+    FROM public.core_bankbalance
+    WHERE account_bank_text = $1
+    ORDER BY core_bankbalance.date_time DESC
+    LIMIT 1
+""", ("account_bank_text",), "balances")
+
+############# EXECUÇÃO E MÉTRICAS #############
+
+# Statements já preparados por sessão: (id da conexão, pid do backend) -> nomes
+_prepared = {}
+
+# nome -> contadores de tempo (em segundos). PREPARE só analisa e reescreve o SQL; o plano é
+# montado dentro de cada EXECUTE, então o tempo de EXECUTE inclui planejamento, execução e envio
+# das linhas. O planejamento em si é medido à parte, por amostragem, com EXPLAIN (SUMMARY).
+STATEMENT_STATS = {}
+
+# A cada quantas execuções de um statement o planejamento é medido (0 desativa a amostragem)
+PLAN_SAMPLE_EVERY = int(os.getenv('QUERY_PLAN_SAMPLE_EVERY', "10"))
+
+# Conexões reaproveitadas entre ciclos (por thread), para que os PREPAREs sobrevivam
+_connections = {}
+
+def get_connection(db_config):
+    """
+    Retorna uma conexão aberta para o db_config, reaproveitando a do ciclo anterior.
+
+    Os statements preparados vivem na sessão; reconectar a cada ciclo
+    obrigaria o servidor a analisar e planejar tudo de novo. Cada thread
+    tem a sua conexão, já que as etapas do ciclo podem rodar em paralelo.
+    """
+    key = (threading.get_ident(),) + tuple(sorted(db_config.items()))
+    conn = _connections.get(key)
+    if conn is None or conn.closed:
+        conn = psycopg2.connect(**db_config)
+        _connections[key] = conn
+    return conn
+
+def close_connections():
+    """Fecha todas as conexões abertas; o próximo ciclo reconecta."""
+    for conn in _connections.values():
+        try:
+            conn.close()
+        except Exception:
+            pass
+    _connections.clear()
+    _prepared.clear()
+
+def _session_key(conn):
+    return (id(conn), conn.get_backend_pid())
+
+def _stats(name):
+    if name not in STATEMENT_STATS:
+        STATEMENT_STATS[name] = {
+            "prepares": 0,
+            "prepare_total": 0.0,
+            "plan_samples": 0,
+            "plan_total": 0.0,
+            "executions": 0,
+            "exec_total": 0.0,
+            "exec_last": 0.0,
+            "exec_max": 0.0,
+        }
+    return STATEMENT_STATS[name]
+
+def prepare_query(cursor, name):
+    """Executa o PREPARE da consulta na sessão do cursor, se ainda não existir."""
+    session = _session_key(cursor.connection)
+    prepared = _prepared.setdefault(session, set())
+    if name in prepared:
+        return
+
+    query = QUERIES[name]
+    types = ", ".join(PARAM_TYPES[param] for param in query["params"])
+    signature = f"({types})" if types else ""
+
+    start = time.perf_counter()
+    cursor.execute(f"PREPARE {name}{signature} AS {query['sql']}")
+    elapsed = time.perf_counter() - start
+
+    stats = _stats(name)
+    stats["prepares"] += 1
+    stats["prepare_total"] += elapsed
+    prepared.add(name)
+
+def _sample_planning(cursor, statement, values, stats):
+    """
+    Mede o planejamento do statement com os mesmos parâmetros, sem executá-lo.
+
+    O "Planning Time" do EXPLAIN EXECUTE é o custo de obter o plano para
+    esses parâmetros: montar um plano custom ou reaproveitar o genérico.
+    """
+    cursor.execute(f"EXPLAIN (SUMMARY, FORMAT JSON) {statement}", values)
+    planning = cursor.fetchone()[0][0]["Planning Time"] / 1000
+    stats["plan_samples"] += 1
+    stats["plan_total"] += planning
+
+def execute_query(cursor, name, params=None):
+    """
+    Executa a consulta registrada `name` via EXECUTE.
+
+    `params` é um dicionário (normalmente o retornado por compute_cycle_bounds)
+    de onde são lidos apenas os parâmetros que a consulta declara.
+    """
+    params = params or {}
+    prepare_query(cursor, name)
+
+    names = QUERIES[name]["params"]
+    values = tuple(params[param] for param in names)
+    placeholders = ", ".join(["%s"] * len(values))
+    statement = f"EXECUTE {name}({placeholders})" if values else f"EXECUTE {name}"
+
+    stats = _stats(name)
+    try:
+        if PLAN_SAMPLE_EVERY and stats["executions"] % PLAN_SAMPLE_EVERY == 0:
+            _sample_planning(cursor, statement, values, stats)
+        start = time.perf_counter()
+        cursor.execute(statement, values)
+    except psycopg2.Error as e:
+        # 26000 = statement inexistente (ex.: sessão reiniciada por DISCARD ALL);
+        # esquece o PREPARE para refazê-lo no próximo ciclo
+        if e.pgcode == "26000":
+            _prepared.get(_session_key(cursor.connection), set()).discard(name)
+        raise
+    elapsed = time.perf_counter() - start
+
+    stats["executions"] += 1
+    stats["exec_total"] += elapsed
+    stats["exec_last"] = elapsed
+    stats["exec_max"] = max(stats["exec_max"], elapsed)
+
+############# ROTEAMENTO E TIMEOUTS #############
+
+class QueryTimeout(Exception):
+    """Consulta cancelada por statement_timeout/lock_timeout."""
+
+# 57014 = query_canceled (statement_timeout), 55P03 = lock_not_available (lock_timeout)
+TIMEOUT_PGCODES = {"57014", "55P03"}
+
+def run_query(name, params=None):
+    """
+    Executa a consulta no banco da sua classe (primário ou réplica) com os timeouts da classe.
+
+    Retorna (linhas, nomes das colunas). Se a consulta for cancelada por
+    timeout, levanta QueryTimeout; o último resultado bom fica a cargo de
+    quem chama (o cache do CycleExecutor, ou manter o valor já na planilha).
+    """
+    query_class = QUERY_CLASSES[QUERIES[name]["query_class"]]
+    config = REPLICA_DB_CONFIG if query_class["target"] == "replica" else DB_CONFIG
+    conn = get_connection(config)
+    try:
+        with conn.cursor() as cursor:
+            # SET LOCAL vale só até o commit/rollback desta consulta
+            cursor.execute("SET LOCAL statement_timeout = %s", (query_class["statement_timeout_ms"],))
+            cursor.execute("SET LOCAL lock_timeout = %s", (query_class["lock_timeout_ms"],))
+            execute_query(cursor, name, params)
+            rows = cursor.fetchall()
+            colnames = [desc[0] for desc in cursor.description]
+        conn.commit()
+    except psycopg2.Error as e:
+        if not conn.closed:
+            conn.rollback()
+        if not isinstance(e, psycopg2.extensions.QueryCanceledError) and e.pgcode not in TIMEOUT_PGCODES:
+            raise
+        raise QueryTimeout(f"{name} cancelada por timeout: {e}") from e
+
+    return rows, colnames
+
+def print_query_stats():
+    """
+    Imprime os tempos acumulados por statement.
+
+    PREPARE é só análise/reescrita; planejamento é a média das amostras do
+    EXPLAIN (SUMMARY); EXECUTE inclui planejamento, execução e envio das linhas.
+    """
+    if not STATEMENT_STATS:
+        return
+    print("\nTempos das consultas (PREPARE / planejamento médio / EXECUTE: último, média, máx):")
+    for name, stats in sorted(STATEMENT_STATS.items()):
+        mean = stats["exec_total"] / stats["executions"] if stats["executions"] else 0.0
+        plan_mean = stats["plan_total"] / stats["plan_samples"] if stats["plan_samples"] else 0.0
+        print(
+            f"  {name}: {stats['prepare_total'] * 1000:.1f}ms ({stats['prepares']}x) / "
+            f"{plan_mean * 1000:.2f}ms ({stats['plan_samples']} amostras) / "
+            f"{stats['exec_last'] * 1000:.1f}ms / {mean * 1000:.1f}ms / "
+            f"{stats['exec_max'] * 1000:.1f}ms ({stats['executions']}x)"
+        )
@@ -0,0 +1,306 @@
+import json
+import os
+import random
+import sqlite3
+import time
+
+# Diretório dos outboxes; cada job tem o seu arquivo (o flush não reivindica linhas,
+# então dois processos no mesmo arquivo mandariam as mesmas escritas)
+OUTBOX_DIR = os.getenv('SHEETS_OUTBOX_DIR', '.')
+
+# Arquivo do token bucket, compartilhado por todos os jobs do host (a cota é da conta de serviço)
+QUOTA_PATH = os.getenv('SHEETS_QUOTA_PATH', 'sheets_quota.db')
+
+# Cota de escrita do Google Sheets (requisições por minuto, compartilhada entre os jobs)
+WRITES_PER_MINUTE = int(os.getenv('SHEETS_WRITES_PER_MINUTE', "60"))
+
+# Quantos ranges vão juntos em uma única requisição batchUpdate
+MAX_BATCH_RANGES = 100
+
+# Status 4xx que ainda indicam falha temporária (timeout e cota); os demais 4xx descartam a escrita
+RETRYABLE_STATUS = {408, 429}
+
+_OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    spreadsheet_id TEXT NOT NULL,
+    worksheet TEXT NOT NULL,
+    anchor TEXT,
+    range_a1 TEXT,
+    payload TEXT,
+    created_at REAL NOT NULL,
+    UNIQUE (kind, spreadsheet_id, worksheet, anchor)
+);
+"""
+
+_BUCKET_SCHEMA = """
+CREATE TABLE IF NOT EXISTS token_bucket (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+############# FUNÇÕES AUXILIARES #############
+
+def outbox_path(job):
+    """Arquivo do outbox de um job (ex.: "indicadores")."""
+    return os.path.join(OUTBOX_DIR, f"sheets_outbox_{job}.db")
+
+def column_letter(col):
+    """Converte o número da coluna em letra (1=A, 27=AA)."""
+    letters = ""
+    while col > 0:
+        col, rest = divmod(col - 1, 26)
+        letters = chr(ord('A') + rest) + letters
+    return letters
+
+def a1_range(start, rows, cols):
+    """Monta o range A1 de um bloco com `rows` x `cols` a partir de start=(linha, coluna)."""
+    row, col = start
+    first = f"{column_letter(col)}{row}"
+    last = f"{column_letter(col + max(cols, 1) - 1)}{row + max(rows, 1) - 1}"
+    return first if first == last else f"{first}:{last}"
+
+def parse_a1(address):
+    """Converte um endereço A1 (ex.: "B3") em (linha, coluna)."""
+    letters = address.rstrip("0123456789")
+    col = 0
+    for char in letters.upper():
+        col = col * 26 + (ord(char) - ord('A') + 1)
+    return int(address[len(letters):]), col
+
+def dataframe_values(df, copy_head=True, nan="NaN"):
+    """Converte o DataFrame em lista de linhas, como o set_dataframe do pygsheets faz."""
+    values = df.fillna(nan).astype(str).values.tolist()
+    if copy_head:
+        values.insert(0, [str(col) for col in df.columns])
+    return values
+
+def _qualified(worksheet, range_a1):
+    title = worksheet.replace("'", "''")
+    return f"'{title}'!{range_a1}" if range_a1 else f"'{title}'"
+
+def _is_permanent(error):
+    """
+    Só um 4xx explícito (fora 408/429) indica que a escrita nunca vai passar.
+
+    Qualquer outra falha (5xx, DNS, queda de conexão, erro ao renovar o
+    token) mantém a escrita no outbox para nova tentativa.
+    """
+    status = getattr(getattr(error, "resp", None), "status", None)
+    try:
+        status = int(status)
+    except (TypeError, ValueError):
+        return False
+    return 400 <= status < 500 and status not in RETRYABLE_STATUS
+
+############# TOKEN BUCKET #############
+
+class TokenBucket:
+    """
+    Token bucket guardado no SQLite, compartilhado por todos os processos que usam o mesmo arquivo.
+
+    Reabastece `rate_per_minute` tokens por minuto até `capacity`; cada requisição
+    ao Sheets consome um token.
+    """
+
+    def __init__(self, path=QUOTA_PATH, name="sheets_writes", rate_per_minute=WRITES_PER_MINUTE, capacity=None):
+        self.path = path
+        self.name = name
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(capacity if capacity is not None else rate_per_minute)
+
+    def try_acquire(self):
+        """Tenta consumir um token. Retorna 0 se conseguiu, ou os segundos até o próximo token."""
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.executescript(_BUCKET_SCHEMA)
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated_at FROM token_bucket WHERE name = ?", (self.name,)).fetchone()
+            tokens = self.capacity if row is None else min(self.capacity, row[0] + (now - row[1]) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            conn.execute(
+                "INSERT OR REPLACE INTO token_bucket (name, tokens, updated_at) VALUES (?, ?, ?)",
+                (self.name, tokens, now),
+            )
+            conn.execute("COMMIT")
+            return wait
+        finally:
+            conn.close()
+
+    def acquire(self):
+        """Bloqueia até conseguir um token."""
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+############# OUTBOX #############
+
+class SheetsOutbox:
+    """
+    Fila local e durável de escritas no Google Sheets.
+
+    Escritas que começam na mesma célula são consolidadas (só a última sobrevive),
+    um clear descarta as escritas pendentes da aba, e appends nunca são
+    consolidados. O flush envia tudo na ordem, em lotes, respeitando o
+    token bucket e com backoff exponencial; o que falhar fica no disco
+    para o próximo ciclo. Cada processo usa o próprio arquivo (outbox_path);
+    só o token bucket é compartilhado.
+    """
+
+    def __init__(self, path, bucket=None):
+        self.path = path
+        self.bucket = bucket or TokenBucket()
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.executescript(_OUTBOX_SCHEMA)
+
+    ############# ENFILEIRAMENTO #############
+
+    def enqueue_values(self, wks, start, values):
+        """
+        Enfileira `values` (lista de linhas) a partir de start=(linha, coluna) ou endereço A1.
+
+        Escritas pendentes que começam na mesma célula da mesma aba são substituídas.
+        """
+        if isinstance(start, str):
+            start = parse_a1(start)
+        anchor = a1_range(start, 1, 1)
+        range_a1 = a1_range(start, len(values), max((len(row) for row in values), default=1))
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO outbox (kind, spreadsheet_id, worksheet, anchor, range_a1, payload, created_at) "
+                "VALUES ('values', ?, ?, ?, ?, ?, ?)",
+                (wks.spreadsheet.id, wks.title, anchor, range_a1, json.dumps(values, default=str), time.time()),
+            )
+
+    def enqueue_cell(self, wks, address, value):
+        """Enfileira a escrita de uma única célula (ex.: "A1")."""
+        self.enqueue_values(wks, address, [[str(value)]])
+
+    def enqueue_dataframe(self, wks, df, start, copy_head=True, nan="NaN"):
+        """Enfileira um DataFrame com a mesma conversão do set_dataframe."""
+        self.enqueue_values(wks, start, dataframe_values(df, copy_head=copy_head, nan=nan))
+
+    def enqueue_append(self, wks, df, copy_head=False, nan="NaN"):
+        """Enfileira um append de linhas ao final da tabela da aba (nunca consolidado)."""
+        values = dataframe_values(df, copy_head=copy_head, nan=nan)
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO outbox (kind, spreadsheet_id, worksheet, range_a1, payload, created_at) "
+                "VALUES ('append', ?, ?, NULL, ?, ?)",
+                (wks.spreadsheet.id, wks.title, json.dumps(values, default=str), time.time()),
+            )
+
+    def enqueue_clear(self, wks):
+        """Enfileira a limpeza da aba; escritas pendentes nela seriam apagadas e são descartadas."""
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM outbox WHERE spreadsheet_id = ? AND worksheet = ? AND kind IN ('values', 'clear')",
+                (wks.spreadsheet.id, wks.title),
+            )
+            self.conn.execute(
+                "INSERT INTO outbox (kind, spreadsheet_id, worksheet, range_a1, payload, created_at) "
+                "VALUES ('clear', ?, ?, NULL, NULL, ?)",
+                (wks.spreadsheet.id, wks.title, time.time()),
+            )
+
+    def pending(self):
+        """Quantidade de escritas aguardando envio."""
+        return self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+    ############# ENVIO #############
+
+    def _batches(self):
+        """Agrupa as escritas pendentes, na ordem, em requisições."""
+        rows = self.conn.execute(
+            "SELECT seq, kind, spreadsheet_id, worksheet, range_a1, payload FROM outbox ORDER BY seq"
+        ).fetchall()
+        batch = []
+        for row in rows:
+            seq, kind, spreadsheet_id = row[0], row[1], row[2]
+            if batch and (
+                kind != 'values'
+                or batch[0][1] != 'values'
+                or batch[0][2] != spreadsheet_id
+                or len(batch) >= MAX_BATCH_RANGES
+            ):
+                yield batch
+                batch = []
+            batch.append(row)
+        if batch:
+            yield batch
+
+    def _send(self, client, batch):
+        kind, spreadsheet_id = batch[0][1], batch[0][2]
+        if kind == 'values':
+            data = [
+                {
+                    "dataFilter": {"a1Range": _qualified(worksheet, range_a1)},
+                    "majorDimension": "ROWS",
+                    "values": json.loads(payload),
+                }
+                for _, _, _, worksheet, range_a1, payload in batch
+            ]
+            client.sheet.values_batch_update_by_data_filter(spreadsheet_id, data)
+        elif kind == 'append':
+            _, _, _, worksheet, _, payload = batch[0]
+            client.sheet.values_append(spreadsheet_id, json.loads(payload), 'ROWS', _qualified(worksheet, "A1"))
+        elif kind == 'clear':
+            client.sheet.values_batch_clear(spreadsheet_id, [_qualified(batch[0][3], None)])
+
+    def _delete(self, batch):
+        with self.conn:
+            self.conn.executemany("DELETE FROM outbox WHERE seq = ?", [(row[0],) for row in batch])
+
+    def flush(self, client, max_retries=5, base_delay=1.0, max_delay=32.0):
+        """
+        Envia as escritas pendentes usando o client do pygsheets.
+
+        Retorna True se a fila ficou vazia. Em falha temporária após
+        `max_retries` tentativas, para e mantém o restante no disco. Um lote
+        com vários ranges recusado de vez é reenviado range a range, para
+        descartar só os que o Sheets rejeita.
+        """
+        sent = 0
+        batches = list(self._batches())
+        while batches:
+            batch = batches.pop(0)
+            attempt = 0
+            while True:
+                self.bucket.acquire()
+                try:
+                    self._send(client, batch)
+                    self._delete(batch)
+                    sent += len(batch)
+                    break
+                except Exception as e:
+                    if _is_permanent(e) and len(batch) > 1:
+                        print(f"⚠️ Lote de {len(batch)} ranges recusado pelo Sheets, reenviando um a um: {e}")
+                        batches[:0] = [[row] for row in batch]
+                        break
+                    if _is_permanent(e):
+                        print(f"❌ Escrita descartada no Sheets ({_qualified(batch[0][3], batch[0][4])}): {e}")
+                        self._delete(batch)
+                        break
+                    if attempt >= max_retries:
+                        print(f"⚠️ Sheets indisponível, {self.pending()} escritas mantidas no outbox: {e}")
+                        return False
+                    delay = min(max_delay, base_delay * 2 ** attempt) * (0.5 + random.random() / 2)
+                    print(f"⚠️ Falha temporária no Sheets, nova tentativa em {delay:.1f}s: {e}")
+                    time.sleep(delay)
+                    attempt += 1
+        if sent:
+            print(f"✓ Outbox: {sent} escritas enviadas ao Sheets")
+        return True
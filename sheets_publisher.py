@@ -0,0 +1,180 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import pygsheets
+
+from sheets_outbox import QUOTA_PATH, SheetsOutbox, TokenBucket, parse_a1
+
+# Destinos extras de publicação, em JSON (variável PUBLISH_TARGETS ou arquivo PUBLISH_TARGETS_PATH).
+# Cada destino:
+#   {"name": "financeiro", "dataset": "indicadores",
+#    "spreadsheet": "Indicadores Financeiro" (ou "spreadsheet_key": "<id>"),
+#    "worksheet": "indicadores",
+#    "columns": ["merchant", "volume_daily"] ou {"merchant": "Merchant", ...},
+#    "mode": "replace" | "append", "start": "A1", "copy_head": true, "clear": false,
+#    "writes_per_minute": 30}
+PUBLISH_TARGETS_PATH = os.getenv('PUBLISH_TARGETS_PATH', 'publish_targets.json')
+
+# Diretório com um outbox por destino, para que um destino com falha não segure os outros
+PUBLISH_OUTBOX_DIR = os.getenv('PUBLISH_OUTBOX_DIR', 'publish_outbox')
+
+# Quanto o ciclo espera pelos destinos; os que passarem disso seguem em segundo plano
+PUBLISH_TIMEOUT = int(os.getenv('PUBLISH_TIMEOUT_SECONDS', "20"))
+
+# Cota padrão de escrita de cada destino (requisições por minuto)
+TARGET_WRITES_PER_MINUTE = int(os.getenv('PUBLISH_WRITES_PER_MINUTE', "30"))
+
+MODES = ("replace", "append")
+
+############# CONFIGURAÇÃO DOS DESTINOS #############
+
+def load_targets():
+    """Lê os destinos de PUBLISH_TARGETS (JSON) ou do arquivo PUBLISH_TARGETS_PATH; sem nenhum, lista vazia."""
+    raw = os.getenv('PUBLISH_TARGETS')
+    if not raw and os.path.exists(PUBLISH_TARGETS_PATH):
+        with open(PUBLISH_TARGETS_PATH, encoding="utf-8") as f:
+            raw = f.read()
+    if not raw or not raw.strip():
+        return []
+    targets = json.loads(raw)
+    names = set()
+    for target in targets:
+        for key in ("name", "dataset", "worksheet"):
+            if key not in target:
+                raise ValueError(f"Destino sem '{key}': {target}")
+        if "spreadsheet" not in target and "spreadsheet_key" not in target:
+            raise ValueError(f"Destino {target['name']} sem 'spreadsheet' ou 'spreadsheet_key'")
+        if target.get("mode", "replace") not in MODES:
+            raise ValueError(f"Modo desconhecido no destino {target['name']}: {target['mode']}")
+        if target["name"] in names:
+            raise ValueError(f"Destino duplicado: {target['name']}")
+        names.add(target["name"])
+    return targets
+
+def project(df, columns):
+    """Aplica a projeção do destino: lista seleciona colunas, dicionário seleciona e renomeia."""
+    if not columns:
+        return df
+    if isinstance(columns, dict):
+        return df[list(columns)].rename(columns=columns)
+    return df[list(columns)]
+
+############# PUBLICADOR #############
+
+class _AllBuckets:
+    """Consome um token de cada bucket (cota do destino e cota global da conta de serviço)."""
+
+    def __init__(self, *buckets):
+        self.buckets = buckets
+
+    def acquire(self):
+        for bucket in self.buckets:
+            bucket.acquire()
+
+class FanOutPublisher:
+    """
+    Publica o mesmo frame, já calculado, em vários destinos (planilha/aba) em paralelo.
+
+    Cada destino tem projeção de colunas, cota de escrita e outbox próprios,
+    então um destino fora do ar só acumula as próprias escritas pendentes
+    (consolidadas: fica só o frame mais recente) sem atrasar os demais.
+    """
+
+    def __init__(self, targets=None, authorize=None, max_workers=4, timeout=PUBLISH_TIMEOUT):
+        self.targets = load_targets() if targets is None else targets
+        self.authorize = authorize or (lambda: pygsheets.authorize(service_account_env_var="GOOGLE_CREDENTIALS"))
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="publicacao")
+        # O client do pygsheets (httplib2) não é thread-safe: um por thread
+        self._local = threading.local()
+        self.global_bucket = TokenBucket(QUOTA_PATH)
+        # nome do destino -> aba já resolvida / future ainda em andamento
+        self.worksheets = {}
+        self.inflight = {}
+        if self.targets:
+            os.makedirs(PUBLISH_OUTBOX_DIR, exist_ok=True)
+            print(f"✓ Publicação configurada para {len(self.targets)} destinos extras")
+
+    def _client(self):
+        if not hasattr(self._local, "client"):
+            self._local.client = self.authorize()
+        return self._local.client
+
+    def _worksheet(self, target):
+        """Abre (e guarda) a aba do destino, criando-a se ainda não existir."""
+        name = target["name"]
+        if name not in self.worksheets:
+            client = self._client()
+            if "spreadsheet_key" in target:
+                sh = client.open_by_key(target["spreadsheet_key"])
+            else:
+                sh = client.open(target["spreadsheet"])
+            try:
+                self.worksheets[name] = sh.worksheet_by_title(target["worksheet"])
+            except pygsheets.WorksheetNotFound:
+                self.worksheets[name] = sh.add_worksheet(target["worksheet"])
+        return self.worksheets[name]
+
+    def _publish_target(self, target, df):
+        """Enfileira o frame projetado no outbox do destino e envia. Retorna True se a fila esvaziou."""
+        frame = project(df, target.get("columns"))
+        wks = self._worksheet(target)
+        bucket = TokenBucket(
+            QUOTA_PATH,
+            name=f"publish:{target['name']}",
+            rate_per_minute=target.get("writes_per_minute", TARGET_WRITES_PER_MINUTE),
+        )
+        # O outbox (SQLite) é aberto na própria thread que o usa
+        outbox = SheetsOutbox(os.path.join(PUBLISH_OUTBOX_DIR, f"{target['name']}.db"), _AllBuckets(bucket, self.global_bucket))
+        try:
+            if target.get("mode", "replace") == "append":
+                outbox.enqueue_append(wks, frame, copy_head=target.get("copy_head", False))
+            else:
+                if target.get("clear", False):
+                    outbox.enqueue_clear(wks)
+                outbox.enqueue_dataframe(wks, frame, parse_a1(target.get("start", "A1")), copy_head=target.get("copy_head", True))
+            return outbox.flush(self._client(), max_retries=target.get("max_retries", 3))
+        finally:
+            outbox.close()
+
+    def publish(self, dataset, df):
+        """
+        Publica `df` em todos os destinos do dataset e retorna {nome: status}.
+
+        Status: "ok", "pendente" (escritas mantidas no outbox do destino),
+        "em andamento" (passou do prazo ou ainda rodando do ciclo anterior)
+        ou "erro".
+        """
+        targets = [target for target in self.targets if target["dataset"] == dataset]
+        if not targets or df.empty:
+            return {}
+
+        submitted = {}
+        statuses = {}
+        for target in targets:
+            name = target["name"]
+            if name in self.inflight and not self.inflight[name].done():
+                statuses[name] = "em andamento"
+                continue
+            submitted[name] = self.inflight[name] = self.pool.submit(self._publish_target, target, df)
+        wait(submitted.values(), timeout=self.timeout)
+
+        for name, future in submitted.items():
+            if not future.done():
+                statuses[name] = "em andamento"
+                continue
+            del self.inflight[name]
+            try:
+                statuses[name] = "ok" if future.result() else "pendente"
+            except Exception as e:
+                print(f"❌ Publicação em {name} falhou: {e}")
+                # Aba pode ter sido apagada/renomeada: resolve de novo no próximo ciclo
+                self.worksheets.pop(name, None)
+                statuses[name] = "erro"
+
+        summary = ", ".join(f"{name}={status}" for name, status in statuses.items())
+        icon = "✓" if all(status == "ok" for status in statuses.values()) else "⚠️"
+        print(f"{icon} Publicação de {dataset}: {summary}")
+        return statuses
@@ -0,0 +1,249 @@
+import argparse
+import os
+import shutil
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pandas as pd
+import pytz
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+# Configuração do fuso horário (partições e horários dos snapshots)
+TZ_SP = pytz.timezone('America/Sao_Paulo')
+
+# Diretório raiz do histórico (um subdiretório por dataset, uma partição por dia)
+SNAPSHOT_STORE_PATH = os.getenv('SNAPSHOT_STORE_PATH', 'snapshots')
+
+# Dias de histórico mantidos; partições mais antigas são apagadas
+RETENTION_DAYS = int(os.getenv('SNAPSHOT_RETENTION_DAYS', "90"))
+
+# Nome do arquivo único de um dia já compactado
+COMPACTED_FILE = "day.arrow"
+
+# Arquivos acumulados no dia corrente a partir dos quais ele também é compactado
+COMPACT_MAX_PARTS = int(os.getenv('SNAPSHOT_COMPACT_MAX_PARTS', "60"))
+
+# Colunas de identificação, mantidas como inteiro; as demais colunas numéricas são gravadas como float
+KEY_COLUMNS = ("merchant_id",)
+
+############# FUNÇÕES AUXILIARES #############
+
+def _normalize(df):
+    """
+    Deixa os tipos estáveis entre ciclos antes de gravar.
+
+    Colunas object com Decimal/números (NUMERIC do psycopg2) viram float e
+    as demais viram texto. Colunas numéricas também viram float, porque um
+    merge que deixa NaN transforma int64 em float64 de um ciclo para o
+    outro; só KEY_COLUMNS ficam inteiras (Int64, que aceita nulo). Assim os
+    arquivos do mesmo dataset têm o mesmo schema e podem ser concatenados.
+    """
+    df = df.copy()
+    for column in df.columns:
+        dtype = df[column].dtype
+        if dtype == object:
+            values = df[column].dropna()
+            if values.map(lambda v: isinstance(v, (Decimal, int, float))).all():
+                df[column] = pd.to_numeric(df[column], errors="coerce").astype(float)
+            else:
+                df[column] = df[column].astype("string")
+        elif pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+            if column in KEY_COLUMNS:
+                df[column] = df[column].astype("Int64")
+            else:
+                df[column] = df[column].astype(float)
+    return df
+
+def _write_atomic(table, path):
+    """Grava a tabela em Arrow IPC sem compressão (legível por memory map) de forma atômica."""
+    tmp_path = f"{path}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+def _read_mapped(path):
+    """Lê um arquivo Arrow IPC via memory map (sem copiar os buffers para a memória)."""
+    with pa.memory_map(path, "r") as source:
+        return pa.ipc.open_file(source).read_all()
+
+def _concat(tables):
+    # Colunas que só existem em parte dos arquivos são preenchidas com null; "permissive"
+    # também junta tipos diferentes da mesma coluna (ex.: int64 e double gravados antes do _normalize)
+    return pa.concat_tables(tables, promote_options="permissive")
+
+############# STORE #############
+
+class SnapshotStore:
+    """
+    Histórico local e colunar dos frames publicados a cada ciclo.
+
+    Cada append grava um arquivo Arrow IPC na partição do dia
+    (<raiz>/<dataset>/date=AAAA-MM-DD/). A compactação junta os arquivos
+    de cada dia em um só, ordenado por merchant e horário, e a
+    retenção apaga os dias mais antigos. As leituras usam memory map e só
+    abrem as partições do intervalo pedido.
+    """
+
+    def __init__(self, root=SNAPSHOT_STORE_PATH, retention_days=RETENTION_DAYS):
+        self.root = root
+        self.retention_days = retention_days
+        self.enabled = pa is not None
+        if not self.enabled:
+            print("⚠️ pyarrow não instalado; histórico de snapshots desativado")
+
+    def _dataset_dir(self, dataset):
+        return os.path.join(self.root, dataset)
+
+    def _partitions(self, dataset):
+        """Partições do dataset como [(data, diretório)], em ordem cronológica."""
+        base = self._dataset_dir(dataset)
+        if not os.path.isdir(base):
+            return []
+        partitions = []
+        for name in sorted(os.listdir(base)):
+            if name.startswith("date="):
+                partitions.append((datetime.strptime(name[5:], "%Y-%m-%d").date(), os.path.join(base, name)))
+        return partitions
+
+    @staticmethod
+    def _files(directory):
+        return sorted(
+            os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".arrow")
+        )
+
+    ############# ESCRITA #############
+
+    def append(self, dataset, df, snapshot_at):
+        """Grava o frame do ciclo com a coluna snapshot_at. Retorna o caminho do arquivo (ou None)."""
+        if not self.enabled or df.empty:
+            return None
+        snapshot_at = snapshot_at.astimezone(TZ_SP)
+        df = _normalize(df)
+        df.insert(0, "snapshot_at", pd.Timestamp(snapshot_at))
+
+        directory = os.path.join(self._dataset_dir(dataset), f"date={snapshot_at:%Y-%m-%d}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"part-{snapshot_at:%H%M%S}-{time.time_ns()}.arrow")
+        _write_atomic(pa.Table.from_pandas(df, preserve_index=False), path)
+        return path
+
+    ############# MANUTENÇÃO #############
+
+    def compact(self, dataset, today=None):
+        """
+        Junta os arquivos de cada dia em um único arquivo. Retorna os dias compactados.
+
+        Dias fechados são compactados sempre que tiverem mais de um arquivo; o
+        dia corrente só quando passar de COMPACT_MAX_PARTS arquivos.
+        """
+        if not self.enabled:
+            return 0
+        today = today or datetime.now(TZ_SP).date()
+        compacted = 0
+        for day, directory in self._partitions(dataset):
+            files = self._files(directory)
+            if len(files) < 2 or (day >= today and len(files) < COMPACT_MAX_PARTS):
+                continue
+            table = _concat([_read_mapped(path) for path in files])
+            sort_keys = [("merchant_id", "ascending")] if "merchant_id" in table.column_names else []
+            table = table.sort_by(sort_keys + [("snapshot_at", "ascending")])
+            _write_atomic(table, os.path.join(directory, COMPACTED_FILE))
+            for path in files:
+                if os.path.basename(path) != COMPACTED_FILE:
+                    os.remove(path)
+            compacted += 1
+        return compacted
+
+    def apply_retention(self, dataset, today=None):
+        """Apaga as partições mais antigas que retention_days. Retorna quantas foram apagadas."""
+        today = today or datetime.now(TZ_SP).date()
+        cutoff = today - timedelta(days=self.retention_days)
+        removed = 0
+        for day, directory in self._partitions(dataset):
+            if day < cutoff:
+                shutil.rmtree(directory)
+                removed += 1
+        return removed
+
+    def maintain(self, dataset, today=None):
+        """Compactação e retenção; barato quando não há nada a fazer, pode rodar todo ciclo."""
+        try:
+            compacted = self.compact(dataset, today)
+            removed = self.apply_retention(dataset, today)
+            if compacted or removed:
+                print(f"✓ Histórico {dataset}: {compacted} dias compactados, {removed} dias removidos")
+        except Exception as e:
+            print(f"⚠️ Erro na manutenção do histórico {dataset}: {e}")
+
+    ############# LEITURA #############
+
+    def read_range(self, dataset, start, end, merchant_id=None, columns=None):
+        """
+        Snapshots com start <= snapshot_at <= end, opcionalmente de um merchant e só com `columns`.
+
+        Só as partições dos dias do intervalo são abertas.
+        """
+        if not self.enabled:
+            return pd.DataFrame()
+        start, end = start.astimezone(TZ_SP), end.astimezone(TZ_SP)
+        tables = []
+        for day, directory in self._partitions(dataset):
+            if not start.date() <= day <= end.date():
+                continue
+            for path in self._files(directory):
+                table = _read_mapped(path)
+                if columns:
+                    table = table.select([c for c in ["snapshot_at", "merchant_id", *columns] if c in table.column_names])
+                mask = pc.and_(
+                    pc.greater_equal(table["snapshot_at"], pa.scalar(start, table.schema.field("snapshot_at").type)),
+                    pc.less_equal(table["snapshot_at"], pa.scalar(end, table.schema.field("snapshot_at").type)),
+                )
+                if merchant_id is not None:
+                    mask = pc.and_(mask, pc.equal(table["merchant_id"], merchant_id))
+                tables.append(table.filter(mask))
+        if not tables:
+            return pd.DataFrame()
+        return _concat(tables).to_pandas().sort_values("snapshot_at", ignore_index=True)
+
+    def merchant_series(self, dataset, merchant_id, column, start, end, freq="1min"):
+        """Série de `column` de um merchant no intervalo, reamostrada em `freq` (último valor de cada intervalo)."""
+        df = self.read_range(dataset, start, end, merchant_id=merchant_id, columns=[column])
+        if df.empty:
+            return pd.Series(dtype=float, name=column)
+        return df.set_index("snapshot_at")[column].resample(freq).last()
+
+def main():
+    parser = argparse.ArgumentParser(description="Consulta e manutenção do histórico local de snapshots.")
+    parser.add_argument("--root", default=SNAPSHOT_STORE_PATH, help="Diretório do histórico")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    series = commands.add_parser("series", help="Série de uma coluna de um merchant")
+    series.add_argument("dataset", help="Dataset (ex.: balances, indicadores)")
+    series.add_argument("--merchant", type=int, required=True, help="merchant_id")
+    series.add_argument("--column", required=True, help="Coluna (ex.: jaci_atual)")
+    series.add_argument("--days", type=float, default=7, help="Dias para trás a partir de agora")
+    series.add_argument("--freq", default="1min", help="Resolução da série (ex.: 1min, 1h)")
+
+    maintain = commands.add_parser("maintain", help="Compacta os dias fechados e aplica a retenção")
+    maintain.add_argument("dataset")
+    args = parser.parse_args()
+
+    store = SnapshotStore(args.root)
+    if args.command == "series":
+        end = datetime.now(TZ_SP)
+        start_time = time.perf_counter()
+        values = store.merchant_series(args.dataset, args.merchant, args.column, end - timedelta(days=args.days), end, args.freq)
+        print(values.dropna().to_string())
+        print(f"\n✓ {values.notna().sum()} pontos em {(time.perf_counter() - start_time) * 1000:.1f}ms")
+    elif args.command == "maintain":
+        store.maintain(args.dataset)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,477 @@
+import argparse
+import csv
+import gc as garbage
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import psycopg2
+import psycopg2.extensions
+import pytz
+
+# Jobs que o soak sabe executar: nome -> módulo com o corpo do loop
+JOBS = ("indicadores", "balances", "daily_balance")
+
+# Hosts aceitos para o banco semeado (o seed apaga e recria as tabelas)
+LOCAL_HOSTS = {None, "", "localhost", "127.0.0.1", "::1"}
+
+MERCHANTS = 40
+
+_SEED_SQL = """
+DROP TABLE IF EXISTS core_payment, core_backofficetrasactions, core_bankbalance, core_merchant;
+
+CREATE TABLE core_merchant (
+    id INTEGER PRIMARY KEY,
+    name_text TEXT NOT NULL,
+    balance_decimal NUMERIC(18, 2) NOT NULL
+);
+
+CREATE TABLE core_payment (
+    id BIGSERIAL PRIMARY KEY,
+    merchant_id INTEGER NOT NULL REFERENCES core_merchant (id),
+    status_text TEXT NOT NULL,
+    method_text TEXT NOT NULL,
+    provider_text TEXT NOT NULL,
+    amount_decimal NUMERIC(18, 2) NOT NULL,
+    created_at_date TIMESTAMPTZ NOT NULL,
+    finalized_at_date TIMESTAMPTZ
+);
+
+CREATE TABLE core_backofficetrasactions (
+    id BIGSERIAL PRIMARY KEY,
+    merchant_id INTEGER NOT NULL REFERENCES core_merchant (id),
+    description_text TEXT NOT NULL,
+    amount_decimal NUMERIC(18, 2) NOT NULL,
+    created_at_date TIMESTAMPTZ NOT NULL
+);
+
+CREATE TABLE core_bankbalance (
+    id BIGSERIAL PRIMARY KEY,
+    date_time TIMESTAMP NOT NULL,
+    account_bank_text TEXT NOT NULL,
+    balance NUMERIC(18, 2) NOT NULL
+);
+
+SELECT setseed(%(seed)s);
+
+INSERT INTO core_merchant (id, name_text, balance_decimal)
+SELECT i, 'Merchant ' || i, round((random() * 100000)::numeric, 2)
+FROM generate_series(1, %(merchants)s) AS i;
+
+INSERT INTO core_payment (merchant_id, status_text, method_text, provider_text, amount_decimal, created_at_date, finalized_at_date)
+SELECT
+    1 + floor(random() * %(merchants)s)::int,
+    (ARRAY['PAID', 'PAID', 'PAID', 'PAID', 'FAIL', 'PENDING'])[1 + floor(random() * 6)::int],
+    (ARRAY['PIX', 'PIX', 'PIXOUT', 'FEE'])[1 + floor(random() * 4)::int],
+    (ARRAY['transfeera', 'sqala'])[1 + floor(random() * 2)::int],
+    round((random() * 500)::numeric, 2),
+    t,
+    t + interval '5 seconds'
+FROM generate_series(%(start)s::timestamptz, %(end)s::timestamptz, %(step)s::interval) AS t;
+
+INSERT INTO core_backofficetrasactions (merchant_id, description_text, amount_decimal, created_at_date)
+SELECT
+    1 + floor(random() * %(merchants)s)::int,
+    (ARRAY['Ajuste', 'Estorno', 'Tarifa'])[1 + floor(random() * 3)::int],
+    round((random() * 1000 - 500)::numeric, 2),
+    t
+FROM generate_series(%(start)s::timestamptz, %(end)s::timestamptz, interval '7 minutes') AS t;
+
+INSERT INTO core_bankbalance (date_time, account_bank_text, balance)
+SELECT t, account, round((random() * 1000000)::numeric, 2)
+FROM generate_series(%(start)s::timestamp, %(end)s::timestamp, interval '10 minutes') AS t,
+     unnest(ARRAY['transfeera', 'sqala']) AS account;
+
+CREATE INDEX ON core_payment (created_at_date);
+CREATE INDEX ON core_payment (finalized_at_date);
+CREATE INDEX ON core_backofficetrasactions (created_at_date);
+ANALYZE;
+"""
+
+############# BANCO SEMEADO #############
+
+def seed_database(dsn, start, end, payments_per_minute, seed):
+    """Recria as tabelas usadas pelas consultas do registro com dados sintéticos entre `start` e `end`."""
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn, conn.cursor() as cursor:
+            cursor.execute(_SEED_SQL, {
+                "seed": seed,
+                "merchants": MERCHANTS,
+                "start": start,
+                "end": end,
+                "step": f"{60.0 / payments_per_minute} seconds",
+            })
+            cursor.execute("SELECT COUNT(*) FROM core_payment")
+            return cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+def configure_environment(dsn, workdir):
+    """Aponta os módulos para o banco local e para arquivos temporários, antes de importá-los."""
+    params = psycopg2.extensions.parse_dsn(dsn)
+    os.environ.update({
+        "DB_HOST": params.get("host", "localhost"),
+        "DB_USER": params.get("user", os.getenv("USER", "postgres")),
+        "DB_PASS": params.get("password", ""),
+        "DB_NAME": params.get("dbname", "postgres"),
+        "DB_PORT": params.get("port", "5432"),
+        "SHEETS_OUTBOX_DIR": workdir,
+        "SHEETS_QUOTA_PATH": os.path.join(workdir, "sheets_quota.db"),
+        "SHEETS_WRITES_PER_MINUTE": "1000000",
+        "WITHDRAWAL_BASELINES_PATH": os.path.join(workdir, "withdrawal_baselines.json"),
+        "WITHDRAWAL_ALERTS_LOG": os.path.join(workdir, "withdrawal_alerts.log"),
+        "SNAPSHOT_STORE_PATH": os.path.join(workdir, "snapshots"),
+        "PUBLISH_OUTBOX_DIR": os.path.join(workdir, "publish_outbox"),
+        "PUBLISH_TARGETS_PATH": os.path.join(workdir, "publish_targets.json"),
+    })
+    # Sem destinos extras: o soak mede só os jobs
+    os.environ.pop("PUBLISH_TARGETS", None)
+    # Sem réplica no soak: todas as classes vão para o banco local
+    for name in ("HOST", "USER", "PASS", "NAME", "PORT"):
+        os.environ.pop(f"DB_REPLICA_{name}", None)
+
+def count_db_connections(monitor):
+    """Conexões abertas no banco local, sem contar a de monitoramento."""
+    with monitor.cursor() as cursor:
+        cursor.execute(
+            "SELECT COUNT(*) FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid()"
+        )
+        return cursor.fetchone()[0]
+
+############# SHEETS OFFLINE #############
+
+class OfflineSheetsAPI:
+    """
+    Substituto das chamadas de valores da API do Sheets usadas pelo outbox.
+
+    Guarda só o último conteúdo de cada range e a contagem de linhas dos
+    appends, para que o próprio substituto não cresça com o número de ciclos.
+    """
+
+    def __init__(self):
+        self.ranges = {}
+        self.appended_rows = {}
+        self.requests = 0
+
+    def values_batch_update_by_data_filter(self, spreadsheet_id, data, **kwargs):
+        self.requests += 1
+        for item in data:
+            self.ranges[(spreadsheet_id, item["dataFilter"]["a1Range"])] = item["values"]
+
+    def values_append(self, spreadsheet_id, values, major_dimension, range, **kwargs):
+        self.requests += 1
+        key = (spreadsheet_id, range)
+        self.appended_rows[key] = self.appended_rows.get(key, 0) + len(values)
+
+    def values_batch_clear(self, spreadsheet_id, ranges, **kwargs):
+        self.requests += 1
+        for cleared in ranges:
+            for key in [key for key in self.ranges if key[0] == spreadsheet_id and key[1].startswith(cleared)]:
+                del self.ranges[key]
+
+class OfflineWorksheet:
+    def __init__(self, spreadsheet, title):
+        self.spreadsheet = spreadsheet
+        self.title = title
+
+    def get_value(self, address):
+        return ""
+
+    def update_values(self, crange, values, **kwargs):
+        self.spreadsheet.client.sheet.values_batch_update_by_data_filter(
+            self.spreadsheet.id, [{"dataFilter": {"a1Range": f"'{self.title}'!{crange}"}, "values": values}]
+        )
+
+class OfflineSpreadsheet:
+    def __init__(self, client, title):
+        self.client = client
+        self.id = f"offline-{title}"
+        self.title = title
+        self.worksheets = {}
+
+    def worksheet_by_title(self, title):
+        if title not in self.worksheets:
+            self.worksheets[title] = OfflineWorksheet(self, title)
+        return self.worksheets[title]
+
+    def add_worksheet(self, title, **kwargs):
+        return self.worksheet_by_title(title)
+
+class OfflineClient:
+    """Client com a mesma interface usada do pygsheets, sem acesso à rede."""
+
+    def __init__(self):
+        self.sheet = OfflineSheetsAPI()
+        self.spreadsheets = {}
+
+    def open(self, title):
+        if title not in self.spreadsheets:
+            self.spreadsheets[title] = OfflineSpreadsheet(self, title)
+        return self.spreadsheets[title]
+
+def install_offline_sheets():
+    """Faz o pygsheets.authorize devolver o client offline, antes de importar os jobs."""
+    import pygsheets
+
+    client = OfflineClient()
+    pygsheets.authorize = lambda *args, **kwargs: client
+    return client
+
+############# JOBS #############
+
+def load_jobs(names):
+    """Importa os módulos dos jobs e devolve nome -> função(sim_now) que executa um ciclo."""
+    from query_registry import compute_cycle_bounds
+
+    jobs = {}
+    for name in names:
+        try:
+            if name == "indicadores":
+                import indicadores_dailybalance
+                jobs[name] = indicadores_dailybalance.run_cycle
+            elif name == "balances":
+                import balances_depuracao
+                jobs[name] = lambda now, run=balances_depuracao.run_cycle: run(compute_cycle_bounds(now))
+            elif name == "daily_balance":
+                import daily_balance_noxpay
+                jobs[name] = lambda now, run=daily_balance_noxpay.check_all_accounts: run()
+        except ImportError as e:
+            print(f"⚠️ Job {name} ignorado: {e}")
+    return jobs
+
+############# MÉTRICAS DO PROCESSO #############
+
+def rss_mb():
+    """Memória residente atual do processo, em MB."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        import resource
+        # Fora do Linux só há o pico (ru_maxrss, em bytes no macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 20
+
+def open_fds():
+    """Descritores de arquivo abertos pelo processo."""
+    for path in ("/proc/self/fd", "/dev/fd"):
+        if os.path.isdir(path):
+            return len(os.listdir(path))
+    return -1
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def slope(values):
+    """Inclinação da reta de mínimos quadrados de `values` por amostra."""
+    n = len(values)
+    if n < 2:
+        return 0.0
+    mean_x = (n - 1) / 2
+    mean_y = sum(values) / n
+    numerator = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values))
+    denominator = sum((x - mean_x) ** 2 for x in range(n))
+    return numerator / denominator
+
+############# AVALIAÇÃO #############
+
+def evaluate(samples, jobs, args):
+    """
+    Compara a janela inicial com a final (depois do aquecimento) e devolve as falhas encontradas.
+
+    Crescimento que se estabiliza passa; o que continua subindo até o fim
+    do soak aparece como diferença entre as janelas.
+    """
+    measured = samples[args.warmup:]
+    window = max(10, len(measured) // 10)
+    if len(measured) < 2 * window:
+        return [f"poucas amostras após o aquecimento ({len(measured)}); aumente --cycles"]
+    first, last = measured[:window], measured[-window:]
+
+    def growth(field, reducer=statistics.median):
+        return reducer(s[field] for s in last) - reducer(s[field] for s in first)
+
+    failures = []
+    checks = [
+        ("RSS", growth("rss_mb"), args.max_rss_growth_mb, "MB"),
+        ("heap Python", growth("heap_mb"), args.max_heap_growth_mb, "MB"),
+        ("descritores abertos", growth("fds", max), args.max_fd_growth, ""),
+        ("conexões no banco", growth("db_connections", max), args.max_conn_growth, ""),
+        ("threads", growth("threads", max), args.max_thread_growth, ""),
+    ]
+    print(f"\nCrescimento entre a janela inicial e a final ({window} ciclos cada):")
+    for label, value, limit, unit in checks:
+        status = "❌" if value > limit else "✓"
+        print(f"  {status} {label}: {value:+.2f}{unit} (limite {limit}{unit})")
+        if value > limit:
+            failures.append(f"{label} cresceu {value:+.2f}{unit}")
+
+    print(f"  RSS: inclinação {slope([s['rss_mb'] for s in measured]) * 1000:+.2f} MB por 1000 ciclos")
+
+    print("\nTempo de ciclo (p50 / p95, em segundos):")
+    for name in jobs:
+        before = [s[f"cycle_{name}"] for s in first]
+        after = [s[f"cycle_{name}"] for s in last]
+        p95_before, p95_after = percentile(before, 0.95), percentile(after, 0.95)
+        ratio = p95_after / p95_before if p95_before else 0.0
+        status = "❌" if ratio > args.max_cycle_slowdown else "✓"
+        print(
+            f"  {status} {name}: início {percentile(before, 0.5):.3f} / {p95_before:.3f} "
+            f"| fim {percentile(after, 0.5):.3f} / {p95_after:.3f} (x{ratio:.2f})"
+        )
+        if ratio > args.max_cycle_slowdown:
+            failures.append(f"p95 do ciclo {name} ficou {ratio:.2f}x mais lento")
+
+    errors = sum(s["errors"] for s in measured)
+    if errors > args.max_errors:
+        failures.append(f"{errors} ciclos com erro")
+    return failures
+
+def print_top_allocators(baseline, limit):
+    """Maiores crescimentos de alocação entre o fim do aquecimento e o fim do soak."""
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+    ])
+    print(f"\nTop {limit} alocadores (crescimento desde o aquecimento):")
+    for stat in snapshot.compare_to(baseline, "lineno")[:limit]:
+        print(f"  {stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+7d} blocos  {stat.traceback}")
+
+############# SOAK #############
+
+def soak(jobs, monitor, args, out):
+    """Executa os ciclos em avanço rápido e coleta as métricas de cada iteração."""
+    from query_registry import close_connections
+
+    sim_now = args.sim_start
+    samples = []
+    baseline = None
+    for iteration in range(1, args.cycles + 1):
+        sample = {"iteration": iteration, "sim_time": sim_now.isoformat(), "errors": 0}
+        for name, run in jobs.items():
+            start = time.perf_counter()
+            try:
+                # daily_balance sinaliza falha retornando False em vez de levantar
+                if run(sim_now) is False:
+                    sample["errors"] += 1
+            except Exception as e:
+                # Mesma recuperação do loop principal dos scripts
+                sample["errors"] += 1
+                print(f"❌ Ciclo {iteration} de {name}: {e}", file=out)
+                close_connections()
+            sample[f"cycle_{name}"] = time.perf_counter() - start
+
+        garbage.collect()
+        sample["rss_mb"] = rss_mb()
+        sample["heap_mb"] = tracemalloc.get_traced_memory()[0] / 2 ** 20 if tracemalloc.is_tracing() else 0.0
+        sample["fds"] = open_fds()
+        sample["db_connections"] = count_db_connections(monitor)
+        sample["threads"] = threading.active_count()
+        samples.append(sample)
+
+        if iteration == args.warmup and tracemalloc.is_tracing():
+            baseline = tracemalloc.take_snapshot()
+        if iteration % args.report_every == 0 or iteration == args.cycles:
+            cycle = " ".join(f"{name}={sample[f'cycle_{name}']:.3f}s" for name in jobs)
+            print(
+                f"[{iteration}/{args.cycles}] {sim_now:%d/%m %H:%M} rss={sample['rss_mb']:.1f}MB "
+                f"heap={sample['heap_mb']:.1f}MB fds={sample['fds']} conexões={sample['db_connections']} "
+                f"threads={sample['threads']} {cycle}",
+                file=out,
+            )
+        sim_now += timedelta(seconds=args.step_seconds)
+    return samples, baseline
+
+def write_csv(path, samples):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(samples[0]))
+        writer.writeheader()
+        writer.writerows(samples)
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test dos loops contra um Postgres local semeado e um Sheets offline.")
+    parser.add_argument("--dsn", default=os.getenv("SOAK_DSN"), help="DSN do Postgres local (padrão: SOAK_DSN); as tabelas são recriadas")
+    parser.add_argument("--job", action="append", choices=JOBS, help="Job a executar (pode repetir; padrão: indicadores e balances)")
+    parser.add_argument("--cycles", type=int, default=2000, help="Quantidade de ciclos")
+    parser.add_argument("--warmup", type=int, default=100, help="Ciclos ignorados na avaliação (carga inicial, caches)")
+    parser.add_argument("--step-seconds", type=int, default=60, help="Avanço do relógio simulado por ciclo")
+    parser.add_argument("--payments-per-minute", type=float, default=5.0, help="Densidade dos pagamentos semeados")
+    parser.add_argument("--seed", type=float, default=0.42, help="Semente do gerador do Postgres (entre -1 e 1)")
+    parser.add_argument("--no-seed", action="store_true", help="Usa os dados já existentes no banco local")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="Desliga o tracemalloc (ciclos mais rápidos)")
+    parser.add_argument("--top", type=int, default=10, help="Quantidade de alocadores listados")
+    parser.add_argument("--report-every", type=int, default=100, help="Intervalo de ciclos entre os relatórios parciais")
+    parser.add_argument("--csv", help="Grava as métricas de cada ciclo neste arquivo")
+    parser.add_argument("--verbose", action="store_true", help="Mostra a saída dos scripts")
+    parser.add_argument("--max-rss-growth-mb", type=float, default=50.0)
+    parser.add_argument("--max-heap-growth-mb", type=float, default=20.0)
+    parser.add_argument("--max-fd-growth", type=int, default=5)
+    parser.add_argument("--max-conn-growth", type=int, default=2)
+    parser.add_argument("--max-thread-growth", type=int, default=2)
+    parser.add_argument("--max-cycle-slowdown", type=float, default=3.0, help="Razão máxima entre o p95 final e o inicial")
+    parser.add_argument("--max-errors", type=int, default=0)
+    args = parser.parse_args()
+
+    if not args.dsn:
+        parser.error("informe --dsn ou SOAK_DSN")
+    host = psycopg2.extensions.parse_dsn(args.dsn).get("host")
+    if host not in LOCAL_HOSTS and not host.startswith("/"):
+        parser.error(f"o soak recria as tabelas; use um Postgres local (host={host})")
+
+    args.sim_start = datetime.now(pytz.timezone('America/Sao_Paulo')).replace(second=0, microsecond=0)
+    sim_end = args.sim_start + timedelta(seconds=args.step_seconds * args.cycles)
+
+    if not args.no_seed:
+        print("Semeando o banco local...")
+        rows = seed_database(args.dsn, args.sim_start - timedelta(days=32), sim_end, args.payments_per_minute, args.seed)
+        print(f"✓ {rows} pagamentos semeados")
+
+    workdir = tempfile.mkdtemp(prefix="soak_")
+    configure_environment(args.dsn, workdir)
+    client = install_offline_sheets()
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+    jobs = load_jobs(args.job or ["indicadores", "balances"])
+    if not jobs:
+        print("❌ Nenhum job disponível")
+        return 1
+
+    out = sys.stdout
+    monitor = psycopg2.connect(args.dsn)
+    monitor.autocommit = True
+    print(f"Soak: {args.cycles} ciclos de {', '.join(jobs)} a partir de {args.sim_start:%d/%m/%Y %H:%M} (arquivos em {workdir})")
+    started = time.perf_counter()
+    try:
+        if not args.verbose:
+            sys.stdout = open(os.devnull, "w")
+        samples, baseline = soak(jobs, monitor, args, out)
+    finally:
+        if sys.stdout is not out:
+            sys.stdout.close()
+            sys.stdout = out
+
+    print(f"\n{'='*50}")
+    print(f"{len(samples)} ciclos em {time.perf_counter() - started:.1f}s | {client.sheet.requests} requisições ao Sheets offline")
+    if args.csv:
+        write_csv(args.csv, samples)
+        print(f"✓ Métricas gravadas em {args.csv}")
+    failures = evaluate(samples, jobs, args)
+    if baseline is not None:
+        print_top_allocators(baseline, args.top)
+    monitor.close()
+
+    print(f"\n{'='*50}")
+    if failures:
+        print("❌ Soak reprovado: " + "; ".join(failures))
+        return 1
+    print("✓ Soak aprovado: memória, descritores e conexões estáveis")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
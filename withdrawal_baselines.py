@@ -0,0 +1,332 @@
+import json
+import os
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from query_registry import TZ_SP, run_query
+
+# Arquivo onde o estado das médias/variâncias é mantido entre ciclos
+BASELINES_PATH = os.getenv('WITHDRAWAL_BASELINES_PATH', 'withdrawal_baselines.json')
+
+# Arquivo de log dos alertas (uma linha JSON por alerta)
+ALERTS_LOG_PATH = os.getenv('WITHDRAWAL_ALERTS_LOG', 'withdrawal_alerts.log')
+
+# Z-score a partir do qual o saque atual é considerado anômalo
+ALERT_Z_SCORE = float(os.getenv('WITHDRAWAL_ALERT_Z_SCORE', "3.0"))
+
+# Mínimo de janelas fechadas no histórico para o merchant poder gerar alerta
+ALERT_MIN_SAMPLES = int(os.getenv('WITHDRAWAL_ALERT_MIN_SAMPLES', "5"))
+
+# Janela das médias/desvios: só buckets que começaram nos últimos N dias entram nas estatísticas
+WINDOW_DAYS = int(os.getenv('WITHDRAWAL_BASELINE_DAYS', "30"))
+
+# Uma hora só é fechada N minutos depois de terminar, para a réplica receber os PIXOUTs dela
+CLOSE_GRACE_MINUTES = int(os.getenv('WITHDRAWAL_CLOSE_GRACE_MINUTES', "10"))
+
+# Versão do formato do arquivo de estado; estado de outra versão refaz a carga inicial
+STATE_VERSION = 2
+
+# Janelas (nome usado nas colunas -> duração em horas)
+WINDOWS = {"1h": 1, "12h": 12, "1d": 24}
+
+# Coluna de saque atual (get_recent_withdrawals) comparada com cada janela
+CURRENT_COLUMNS = {
+    "1h": "current_1h_withdrawals",
+    "12h": "sum_12h_withdrawals",
+    "1d": "sum_24h_withdrawals",
+}
+
+METRICS = ("volume", "quantidade")
+
+############# WELFORD #############
+
+class Welford:
+    """Média e variância online (algoritmo de Welford)."""
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def remove(self, value):
+        """Desfaz um update(value) feito antes (valor saindo da janela)."""
+        if self.count <= 1:
+            self.count, self.mean, self.m2 = 0, 0.0, 0.0
+            return
+        self.count -= 1
+        delta = value - self.mean
+        self.mean -= delta / self.count
+        # Arredondamento pode deixar m2 levemente negativo
+        self.m2 = max(0.0, self.m2 - delta * (value - self.mean))
+
+    @property
+    def std(self):
+        """Desvio padrão amostral (ddof=1, igual ao pandas)."""
+        if self.count < 2:
+            return float("nan")
+        return (self.m2 / (self.count - 1)) ** 0.5
+
+    def zscore(self, value):
+        std = self.std
+        if not std or std != std:
+            return None
+        return (value - self.mean) / std
+
+############# BASELINES #############
+
+def _floor(hour, window_hours):
+    """Início do bucket da janela que contém `hour` (alinhado à meia-noite, como o pd.Grouper)."""
+    if window_hours >= 24:
+        return hour.replace(hour=0)
+    return hour.replace(hour=hour.hour - hour.hour % window_hours)
+
+class WithdrawalBaselines:
+    """
+    Estatísticas por merchant do volume/quantidade de PIXOUT em janelas fechadas de 1h, 12h e 1d, nos últimos WINDOW_DAYS dias.
+
+    A cada hora fechada só os saques daquela hora são lidos do banco e
+    somados às estatísticas; os buckets que saem da janela são subtraídos
+    (por isso os valores de cada bucket ficam guardados enquanto estão na
+    janela). O histórico completo é varrido apenas na primeira carga.
+    """
+
+    def __init__(self, path=BASELINES_PATH):
+        self.path = path
+        # update() pode rodar numa etapa em segundo plano enquanto o ciclo lê os baselines
+        self.lock = threading.RLock()
+        self.reset()
+        self.load()
+
+    def reset(self):
+        self.last_closed_hour = None
+        self.merchants = {}
+        self.stats = {window: {} for window in WINDOWS}
+        # Buckets fechados ainda dentro da janela: deque de (início, {merchant_id: [volume, quantidade]})
+        self.history = {window: deque() for window in WINDOWS}
+        # Bucket aberto de cada janela: (início, {merchant_id: [volume, quantidade]})
+        self.open_buckets = {window: (None, {}) for window in WINDOWS}
+
+    ############# PERSISTÊNCIA #############
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            if state.get("version") != STATE_VERSION:
+                raise ValueError(f"versão {state.get('version')} do estado, esperada {STATE_VERSION}")
+            self.last_closed_hour = datetime.fromisoformat(state["last_closed_hour"])
+            self.merchants = {merchant_id: name for merchant_id, name in state["merchants"]}
+            for window in WINDOWS:
+                self.stats[window] = {
+                    merchant_id: {metric: Welford(*values[metric]) for metric in METRICS}
+                    for merchant_id, values in state["stats"][window]
+                }
+                self.history[window] = deque(
+                    (datetime.fromisoformat(start), {merchant_id: values for merchant_id, values in sums})
+                    for start, sums in state["history"][window]
+                )
+                start, sums = state["open_buckets"][window]
+                self.open_buckets[window] = (
+                    datetime.fromisoformat(start) if start else None,
+                    {merchant_id: values for merchant_id, values in sums},
+                )
+        except Exception as e:
+            print(f"⚠️ Estado de baselines inválido, refazendo carga inicial: {e}")
+            self.reset()
+
+    def save(self):
+        state = {
+            "version": STATE_VERSION,
+            "last_closed_hour": self.last_closed_hour.isoformat(),
+            "merchants": list(self.merchants.items()),
+            "stats": {
+                window: [
+                    [merchant_id, {metric: [s.count, s.mean, s.m2] for metric, s in values.items()}]
+                    for merchant_id, values in stats.items()
+                ]
+                for window, stats in self.stats.items()
+            },
+            "history": {
+                window: [[start.isoformat(), list(sums.items())] for start, sums in history]
+                for window, history in self.history.items()
+            },
+            "open_buckets": {
+                window: [start.isoformat() if start else None, list(sums.items())]
+                for window, (start, sums) in self.open_buckets.items()
+            },
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    ############# ATUALIZAÇÃO #############
+
+    def _push_bucket(self, window, start, sums):
+        """Soma um bucket fechado às estatísticas e o guarda para subtrair quando sair da janela."""
+        for merchant_id, (volume, quantidade) in sums.items():
+            stats = self.stats[window].setdefault(merchant_id, {metric: Welford() for metric in METRICS})
+            stats["volume"].update(volume)
+            stats["quantidade"].update(quantidade)
+        self.history[window].append((start, sums))
+
+    def _expire(self, cutoff):
+        """Subtrai das estatísticas os buckets que começaram antes de `cutoff`."""
+        for window, history in self.history.items():
+            while history and history[0][0] < cutoff:
+                _, sums = history.popleft()
+                for merchant_id, (volume, quantidade) in sums.items():
+                    stats = self.stats[window][merchant_id]
+                    stats["volume"].remove(volume)
+                    stats["quantidade"].remove(quantidade)
+                    if stats["volume"].count == 0:
+                        del self.stats[window][merchant_id]
+
+    def _close_buckets(self, until_hour):
+        """Fecha os buckets de 12h/1d cujo fim já passou de `until_hour`."""
+        for window, hours in WINDOWS.items():
+            if hours == 1:
+                continue
+            start, sums = self.open_buckets[window]
+            if start is not None and _floor(until_hour, hours) > start:
+                self._push_bucket(window, start, sums)
+                self.open_buckets[window] = (None, {})
+
+    def _add_hour(self, hour, sums):
+        """Incorpora uma hora fechada: {merchant_id: [volume, quantidade]}."""
+        self._close_buckets(hour)
+        self._push_bucket("1h", hour, sums)
+        for window, hours in WINDOWS.items():
+            if hours == 1:
+                continue
+            start, bucket = self.open_buckets[window]
+            if start is None:
+                start = _floor(hour, hours)
+            for merchant_id, (volume, quantidade) in sums.items():
+                totals = bucket.setdefault(merchant_id, [0.0, 0])
+                totals[0] += volume
+                totals[1] += quantidade
+            self.open_buckets[window] = (start, bucket)
+
+    def update(self, now):
+        """
+        Incorpora as horas fechadas desde a última atualização e tira da janela as antigas.
+
+        Uma hora só conta como fechada CLOSE_GRACE_MINUTES depois de terminar,
+        para a réplica já ter recebido os saques dela. Retorna a quantidade
+        de horas processadas (0 se nenhuma hora fechou).
+        Um timeout levanta QueryTimeout e o estado fica como estava
+        (reaproveitar o resultado em cache contaria horas em dobro).
+        """
+        closed_until = now.astimezone(TZ_SP) - timedelta(minutes=CLOSE_GRACE_MINUTES)
+        current_hour = closed_until.replace(tzinfo=None, minute=0, second=0, microsecond=0)
+        window_start = current_hour - timedelta(days=WINDOW_DAYS)
+        with self.lock:
+            last_closed_hour = self.last_closed_hour
+        # Sem estado, ou estado mais velho que a janela: refaz a carga inicial
+        bootstrap = last_closed_hour is None or last_closed_hour < window_start
+        if bootstrap:
+            start_hour = window_start
+            print(f"Carga inicial dos baselines de saque ({WINDOW_DAYS} dias)...")
+        else:
+            start_hour = last_closed_hour + timedelta(hours=1)
+        if start_hour >= current_hour:
+            return 0
+
+        # A consulta fica fora do lock para não travar quem só lê os baselines
+        params = {
+            "start_date": TZ_SP.localize(start_hour),
+            "end_date": TZ_SP.localize(current_hour) - timedelta(microseconds=1),
+        }
+        rows, colnames = run_query("get_withdrawals", params)
+        df = pd.DataFrame(rows, columns=colnames)
+
+        hours = {}
+        for row in df.sort_values("data_hora").itertuples(index=False):
+            hour = pd.Timestamp(row.data_hora).to_pydatetime()
+            totals = hours.setdefault(hour, {}).setdefault(row.merchant_id, [0.0, 0])
+            totals[0] += float(row.volume)
+            totals[1] += int(row.quantidade)
+
+        with self.lock:
+            if bootstrap:
+                self.reset()
+            for row in df[["merchant_id", "merchant"]].drop_duplicates().itertuples(index=False):
+                self.merchants[row.merchant_id] = row.merchant
+            for hour, sums in hours.items():
+                self._add_hour(hour, sums)
+            self._close_buckets(current_hour)
+            self._expire(window_start)
+
+            self.last_closed_hour = current_hour - timedelta(hours=1)
+            self.save()
+        return int((current_hour - start_hour) / timedelta(hours=1))
+
+    ############# CONSULTA #############
+
+    def to_frame(self):
+        """Baselines dos últimos WINDOW_DAYS dias no mesmo formato que get_withdrawal_metrics sempre devolveu."""
+        with self.lock:
+            columns = ["merchant_id", "merchant"] + [
+                f"{stat}_{window}_{metric}" for window in WINDOWS for metric in METRICS for stat in ("mean", "std")
+            ]
+            rows = []
+            active = set().union(*(stats.keys() for stats in self.stats.values()))
+            for merchant_id, name in self.merchants.items():
+                if merchant_id not in active:
+                    continue
+                row = [merchant_id, name]
+                for window in WINDOWS:
+                    stats = self.stats[window].get(merchant_id)
+                    for metric in METRICS:
+                        if stats is None:
+                            row += [float("nan"), float("nan")]
+                        else:
+                            row += [stats[metric].mean, stats[metric].std]
+                rows.append(row)
+            return pd.DataFrame(rows, columns=columns)
+
+    def detect_anomalies(self, df_recent, now, z_threshold=ALERT_Z_SCORE, min_samples=ALERT_MIN_SAMPLES):
+        """Compara os saques atuais de cada merchant com os baselines e devolve os que passam do z-score."""
+        with self.lock:
+            alerts = []
+            for row in df_recent.to_dict("records"):
+                for window, column in CURRENT_COLUMNS.items():
+                    value = row.get(column)
+                    stats = self.stats[window].get(row["merchant_id"])
+                    if value is None or pd.isna(value) or stats is None or stats["volume"].count < min_samples:
+                        continue
+                    z = stats["volume"].zscore(float(value))
+                    if z is not None and z > z_threshold:
+                        alerts.append({
+                            "data_hora": now.strftime("%d/%m/%Y %H:%M:%S"),
+                            "merchant_id": row["merchant_id"],
+                            "merchant": row["merchant"],
+                            "janela": window,
+                            "valor_atual": round(float(value), 2),
+                            "media": round(stats["volume"].mean, 2),
+                            "desvio": round(stats["volume"].std, 2),
+                            "z_score": round(z, 2),
+                        })
+            return pd.DataFrame(alerts, columns=[
+                "data_hora", "merchant_id", "merchant", "janela", "valor_atual", "media", "desvio", "z_score"
+            ])
+
+def log_alerts(df_alerts, path=ALERTS_LOG_PATH):
+    """Acrescenta os alertas ao log local, uma linha JSON por alerta."""
+    if df_alerts.empty:
+        return
+    with open(path, "a", encoding="utf-8") as f:
+        for alert in df_alerts.to_dict("records"):
+            f.write(json.dumps(alert, ensure_ascii=False, default=str) + "\n")